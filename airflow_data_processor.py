@@ -22,6 +22,7 @@ bash_script_path = os.path.join(os.path.dirname(__file__), 'bash_script')
 
 import etl_stock_flow_reports
 import etl_retention_and_sunset
+import index_manifest
 
 
 # DAG arguments
@@ -44,12 +45,18 @@ dag = DAG(
     catchup=False,
 )
 
-# Task 1 - Copy the bash script to /tmp and make them executable - we need to do this because of file permission issues
+# Task 1 - Copy the bash script to /tmp and make them executable - we need to do this because of file permission issues.
+# The transfer manifest is checked against the ETL queries first, so that a drift stops the whole run
 task1 = BashOperator(
     task_id='copy_and_chmod_script',
-    bash_command=f'cp {os.path.join(bash_script_path, "transfer.sh")} /tmp/transfer.sh && '
+    bash_command=f'python3 {os.path.join(os.path.dirname(__file__), "python", "transfer_manifest.py")} && '
+                 f'cp {os.path.join(bash_script_path, "transfer.sh")} /tmp/transfer.sh && '
                  f'cp {os.path.join(bash_script_path, "rename_tmp.sh")} /tmp/rename_tmp.sh && '
                  f'cp {os.path.join(bash_script_path, "report_merged_non_bundle.sh")} /tmp/report_merged_non_bundle.sh && '
+                 f'cp {os.path.join(bash_script_path, "export_variables.py")} /tmp/export_variables.py && '
+                 f'cp {os.path.join(bash_script_path, "copy_tables.py")} /tmp/copy_tables.py && '
+                 f'cp {os.path.join(bash_script_path, "transfer_manifest.json")} /tmp/transfer_manifest.json && '
+                 f'cp {os.path.join(bash_script_path, "index_manifest.json")} /tmp/index_manifest.json && '
                  f'chmod +x /tmp/transfer.sh /tmp/rename_tmp.sh /tmp/report_merged_non_bundle.sh ',
     dag=dag,
 )
@@ -215,14 +222,49 @@ task22 = PythonOperator(
 # Task 23 - Clean up: remove the temporary scripts
 task23 = BashOperator(
     task_id='cleanup',
-    bash_command='rm /tmp/transfer.sh /tmp/rename_tmp.sh /tmp/report_merged_non_bundle.sh ',
+    bash_command='rm /tmp/transfer.sh /tmp/rename_tmp.sh /tmp/report_merged_non_bundle.sh /tmp/export_variables.py /tmp/copy_tables.py /tmp/transfer_manifest.json /tmp/index_manifest.json ',
+    dag=dag,
+)
+
+# Task 24 - Check the plans of the extract queries against the index manifest - for the brand ABC
+task24 = PythonOperator(
+    task_id='check_index_manifest_abc',
+    python_callable=index_manifest.run_index_manifest_abc,
+    dag=dag,
+)
+
+# Task 25 - Check the plans of the extract queries against the index manifest - for the brand DEF
+task25 = PythonOperator(
+    task_id='check_index_manifest_def',
+    python_callable=index_manifest.run_index_manifest_def,
+    dag=dag,
+)
+
+# Task 26 - Check the plans of the extract queries against the index manifest - for the brand GHI
+task26 = PythonOperator(
+    task_id='check_index_manifest_ghi',
+    python_callable=index_manifest.run_index_manifest_ghi,
+    dag=dag,
+)
+
+# Task 27 - Check the plans of the extract queries against the index manifest - for the brand JKL
+task27 = PythonOperator(
+    task_id='check_index_manifest_jkl',
+    python_callable=index_manifest.run_index_manifest_jkl,
+    dag=dag,
+)
+
+# Task 28 - Check the plans of the extract queries against the index manifest - for the brand MNO
+task28 = PythonOperator(
+    task_id='check_index_manifest_mno',
+    python_callable=index_manifest.run_index_manifest_mno,
     dag=dag,
 )
 
 # Task Pipeline
-task1 >> task2 >> task7 >> task12 >> task18
-task1 >> task3 >> task8 >> task13 >> task19
-task1 >> task4 >> task9 >> task14 >> task20
-task1 >> task5 >> task10 >> task15 >> task21
-task1 >> task6 >> task11 >> task16 >> task22
+task1 >> task2 >> task7 >> task24 >> task12 >> task18
+task1 >> task3 >> task8 >> task25 >> task13 >> task19
+task1 >> task4 >> task9 >> task26 >> task14 >> task20
+task1 >> task5 >> task10 >> task27 >> task15 >> task21
+task1 >> task6 >> task11 >> task28 >> task16 >> task22
 [task18, task19, task20, task21, task22] >> task17 >> task23
@@ -0,0 +1,651 @@
+"""
+Copy CRM tables of a brand from the source DB to <table>_tmp tables in the target DB
+
+Usage: python3 copy_tables.py BRAND table [table ...]
+
+The DDL of every <table>_tmp table is built from information_schema, and the rows are streamed from the
+source straight into batched inserts on the target, without an intermediate dump file.
+
+Tables listed in transfer_manifest.json only get the columns (and rows, with "where") the ETLs read.
+A "parent" is the table the "where" depends on, whose updates can bring rows into the copied slice.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import queue
+import random
+import sys
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+from airflow.models import Variable
+
+# Number of rows fetched from the source and inserted into the target at once
+COPY_BATCH_SIZE = 1000
+
+# Default number of tables of a brand in flight at once (Variable transfer_copy_workers). Each of them waits for
+# a slot before reading from the source or writing to the target, the slots set the actual concurrency
+COPY_WORKERS = 16
+
+# Default caps on the concurrent exports from one source host (Variable transfer_max_exports_per_host) and on the
+# concurrent imports into one target host (Variable transfer_max_imports_per_host), shared by all the brands
+MAX_EXPORTS_PER_HOST = 6
+MAX_IMPORTS_PER_HOST = 6
+
+# Prefix of the named locks (GET_LOCK) of the slots. They live on the MySQL server, so the slots are shared by the
+# transfers of all the brands, whichever Airflow worker or machine runs them
+SLOT_LOCK_PREFIX = 'transfer_slot'
+
+# Seconds a worker waits on the server for one slot before trying the next one
+SLOT_WAIT_SECONDS = 10
+
+# Number of fetched batches buffered between the export and the import of a table
+STREAM_QUEUE_BATCHES = 4
+
+# Slot caps of a run: exports are counted on the source server, imports on the target server
+SlotLimits = namedtuple('SlotLimits', ['export_config', 'max_exports', 'import_config', 'max_imports'])
+
+# Table in the target DB keeping the change fingerprint of each copied table. fingerprint belongs to the
+# main table, pending_fingerprint to the <table>_tmp copy waiting for rename_tmp.sh
+FINGERPRINT_TABLE = 'transfer_fingerprint'
+
+# Tables that mostly grow by appends. Between two full resyncs, only their new and updated rows are merged into the
+# main table, without going through <table>_tmp
+INCREMENTAL_TABLES = ('sylius_order_item', 'sylius_order_action_history', 'sylius_payment', 'sylius_order_tasks')
+
+# Default hours between two full resyncs of an incremental table, which also drop the rows deleted from the source
+# (Variable transfer_full_resync_hours)
+FULL_RESYNC_HOURS = 24
+
+# How far back an incremental sync looks on updated_at, for rows committed after rows with a later updated_at
+SYNC_OVERLAP = datetime.timedelta(minutes=10)
+
+# Table in the target DB keeping the time of the last full resync of each incremental table. pending_full_sync_at
+# belongs to the <table>_tmp copy waiting for rename_tmp.sh
+SYNC_STATE_TABLE = 'transfer_sync_state'
+
+# Columns and rows of the tables the ETLs need, checked against the ETL queries by python/transfer_manifest.py
+MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transfer_manifest.json')
+
+# Indexes the ETL joins and filters need, added to the <table>_tmp copies. Their plans are checked by
+# python/index_manifest.py
+INDEX_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index_manifest.json')
+
+
+def get_db_details(brand):
+    """Get the source (CRM) and target database details for the given brand"""
+    source = {
+        'database': Variable.get(f'source_crm_db_name_{brand.lower()}'),
+        'user': Variable.get('source_crm_db_user'),
+        'password': Variable.get('source_crm_db_password'),
+        'host': Variable.get('source_crm_db_host')
+    }
+    target = {
+        'database': Variable.get(f'target_db_name_{brand.lower()}'),
+        'user': Variable.get('target_db_user'),
+        'password': Variable.get('target_db_password'),
+        'host': Variable.get('target_db_host'),
+        'port': Variable.get('target_db_port')
+    }
+    return source, target
+
+
+def connect(connection_config):
+    """Open a connection with the settings used on both sides of a copy"""
+    return mysql.connector.connect(charset='utf8mb4', autocommit=False, **connection_config)
+
+
+def quote_name(name):
+    """Quote a table, column or index name"""
+    return "`" + name.replace("`", "``") + "`"
+
+
+def quote_literal(value):
+    """Quote a string literal for a DDL statement"""
+    return "'" + value.replace("\\", "\\\\").replace("'", "''") + "'"
+
+
+def fetch_dicts(cursor, query, params):
+    """Run a query and return its rows as dictionaries with lowercase keys"""
+    cursor.execute(query, params)
+    columns = [column[0].lower() for column in cursor.description]
+    # Some information_schema columns are returned as bytes by MySQL 8
+    return [
+        {column: value.decode('utf-8') if isinstance(value, (bytes, bytearray)) else value for column, value in zip(columns, row)}
+        for row in cursor.fetchall()
+    ]
+
+
+def is_generated(column):
+    """Whether a column is computed by the server, in which case its values are not copied"""
+    return 'GENERATED' in (column['extra'] or '').replace('DEFAULT_GENERATED', '')
+
+
+def get_table_definition(cursor, schema, table):
+    """Read the columns and indexes of a source table from information_schema"""
+    columns = fetch_dicts(cursor, """
+    SELECT column_name, column_type, data_type, is_nullable, column_default, extra, generation_expression, column_comment
+    FROM information_schema.columns
+    WHERE table_schema = %s AND table_name = %s
+    ORDER BY ordinal_position
+    """, (schema, table))
+
+    indexes = fetch_dicts(cursor, """
+    SELECT index_name, non_unique, column_name, sub_part, collation, index_type
+    FROM information_schema.statistics
+    WHERE table_schema = %s AND table_name = %s
+    ORDER BY index_name = 'PRIMARY' DESC, index_name, seq_in_index
+    """, (schema, table))
+
+    return columns, indexes
+
+
+def column_definition(column, is_mariadb):
+    """Build the definition of a column, with the rewrites the mysqldump + sed chain used to apply:
+    nullable json columns become LONGTEXT, and character sets, collations and DEFAULT NULL are left out
+    """
+    column_type = column['column_type']
+    if column['data_type'] == 'json' and column['is_nullable'] == 'YES':
+        column_type = 'LONGTEXT'
+    parts = [quote_name(column['column_name']), column_type]
+
+    extra = column['extra'] or ''
+    if is_generated(column):
+        storage = 'VIRTUAL' if 'VIRTUAL' in extra else 'STORED'
+        parts.append(f"GENERATED ALWAYS AS ({column['generation_expression']}) {storage}")
+    if column['is_nullable'] == 'NO':
+        parts.append('NOT NULL')
+    if not is_generated(column):
+        default = column['column_default']
+        if default is not None and not (is_mariadb and default == 'NULL'):
+            if is_mariadb:
+                # MariaDB already reports defaults as SQL: quoted literals, NULL or expressions
+                parts.append(f"DEFAULT {default}")
+            elif 'DEFAULT_GENERATED' in extra:
+                expression = default if default.upper().startswith('CURRENT_TIMESTAMP') else f"({default})"
+                parts.append(f"DEFAULT {expression}")
+            elif default.startswith("b'"):
+                parts.append(f"DEFAULT {default}")
+            else:
+                parts.append(f"DEFAULT {quote_literal(default)}")
+
+    extra = extra.replace('DEFAULT_GENERATED', '').replace('INVISIBLE', '').strip()
+    if 'auto_increment' in extra:
+        parts.append('AUTO_INCREMENT')
+    if extra.lower().startswith('on update'):
+        parts.append(extra.upper())
+    if 'INVISIBLE' in (column['extra'] or ''):
+        parts.append('INVISIBLE')
+
+    if column['column_comment']:
+        parts.append(f"COMMENT {quote_literal(column['column_comment'])}")
+    return ' '.join(parts)
+
+
+def index_definitions(indexes):
+    """Build the key definitions of a table from its information_schema.statistics rows"""
+    keys = {}
+    for index in indexes:
+        # Functional key parts have no column, they can't be rebuilt from the column list
+        if index['column_name'] is None:
+            keys[index['index_name']] = None
+            continue
+        if index['index_name'] in keys and keys[index['index_name']] is None:
+            continue
+        key_part = quote_name(index['column_name'])
+        if index['sub_part'] is not None:
+            key_part += f"({index['sub_part']})"
+        if index['collation'] == 'D':
+            key_part += ' DESC'
+        keys.setdefault(index['index_name'], (index, []))[1].append(key_part)
+
+    definitions = []
+    for name, key in keys.items():
+        if key is None:
+            print(f"WARNING: functional index {name} is not copied.")
+            continue
+        index, key_parts = key
+        key_parts = ', '.join(key_parts)
+        if name == 'PRIMARY':
+            definitions.append(f"PRIMARY KEY ({key_parts})")
+        elif index['index_type'] in ('FULLTEXT', 'SPATIAL'):
+            definitions.append(f"{index['index_type']} KEY {quote_name(name)} ({key_parts})")
+        elif not int(index['non_unique']):
+            definitions.append(f"UNIQUE KEY {quote_name(name)} ({key_parts})")
+        else:
+            definitions.append(f"KEY {quote_name(name)} ({key_parts})")
+    return definitions
+
+
+def build_tmp_ddl(table, columns, indexes, is_mariadb):
+    """Build the CREATE TABLE statement of <table>_tmp
+
+    As with the former dump rewrites, foreign keys, CHECK constraints, the engine, the AUTO_INCREMENT
+    counter and the default character set are left out, the target DB defaults apply instead
+    """
+    definitions = [column_definition(column, is_mariadb) for column in columns] + index_definitions(indexes)
+    definitions_str = ',\n    '.join(definitions)
+    return f"CREATE TABLE {quote_name(table + '_tmp')} (\n    {definitions_str}\n)"
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """Load the projection manifest by table name, or the manifest at path"""
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def add_manifest_indexes(table, columns, indexes, manifest_indexes):
+    """Add the manifest indexes of a table to its index rows, unless an index already starts with their columns"""
+    column_names = {column['column_name'] for column in columns}
+    current = {}
+    for index in indexes:
+        current.setdefault(index['index_name'], []).append(index['column_name'])
+
+    indexes = list(indexes)
+    for manifest_index in manifest_indexes:
+        key_columns = manifest_index['columns']
+        # An index whose leading columns are the manifest columns serves the same lookups, e.g. a foreign key index
+        if any(index_columns[:len(key_columns)] == key_columns for index_columns in current.values()):
+            continue
+        missing = [column for column in key_columns if column not in column_names]
+        if missing:
+            raise ValueError(f"Columns {', '.join(missing)} of index {manifest_index['name']} don't exist in {table}")
+        indexes.extend({'index_name': manifest_index['name'], 'non_unique': 1, 'column_name': column,
+                        'sub_part': None, 'collation': 'A', 'index_type': 'BTREE'} for column in key_columns)
+    return indexes
+
+
+def project_table(table, columns, indexes, projection):
+    """Keep only the columns of the projection, with the primary key and updated_at used to sync the table,
+    and the indexes left complete
+    """
+    column_names = [column['column_name'] for column in columns]
+    missing = [column for column in projection['columns'] if column not in column_names]
+    if missing:
+        raise ValueError(f"Columns {', '.join(missing)} of the manifest don't exist in {table}")
+
+    kept = set(projection['columns']) | {'updated_at'}
+    kept |= {index['column_name'] for index in indexes if index['index_name'] == 'PRIMARY'}
+    dropped_indexes = {index['index_name'] for index in indexes if index['column_name'] not in kept}
+    return ([column for column in columns if column['column_name'] in kept],
+            [index for index in indexes if index['index_name'] not in dropped_indexes])
+
+
+def table_fingerprint(cursor, table, columns, projection=None):
+    """Compute a fingerprint of the source table that changes whenever its rows do
+
+    Row count with the highest id and updated_at when the table has an updated_at column, CHECKSUM TABLE otherwise,
+    since in-place updates of such a table don't show in its count or ids
+    """
+    column_names = {column['column_name'] for column in columns}
+    if 'updated_at' not in column_names:
+        cursor.execute(f"CHECKSUM TABLE {quote_name(table)}")
+        fingerprint = f"checksum={cursor.fetchone()[1]}"
+    else:
+        max_id = "MAX(`id`)" if 'id' in column_names else "NULL"
+        cursor.execute(f"SELECT COUNT(*), {max_id}, MAX(`updated_at`) FROM {quote_name(table)}")
+        row_count, last_id, last_updated_at = cursor.fetchone()
+        fingerprint = f"count={row_count};max_id={last_id};max_updated_at={last_updated_at}"
+
+    # Rows can enter the copied slice through an update of their parent (e.g., an order being paid)
+    if projection is not None and 'parent' in projection:
+        cursor.execute(f"SELECT MAX(`updated_at`) FROM {quote_name(projection['parent']['table'])}")
+        fingerprint += f";parent_updated_at={cursor.fetchone()[0]}"
+    return fingerprint
+
+
+def get_transfer_state(target_config):
+    """Get the fingerprints of the main tables of the target DB that still exist, and the time of the last
+    full resync of the incremental tables, both by table name
+    """
+    connection = connect(target_config)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {FINGERPRINT_TABLE} (
+            table_name VARCHAR(64) NOT NULL PRIMARY KEY,
+            fingerprint VARCHAR(255) NULL,
+            pending_fingerprint VARCHAR(255) NULL
+        )
+        """)
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SYNC_STATE_TABLE} (
+            table_name VARCHAR(64) NOT NULL PRIMARY KEY,
+            last_full_sync_at DATETIME NULL,
+            pending_full_sync_at DATETIME NULL
+        )
+        """)
+        # A main table dropped since its last copy is copied again, whatever its fingerprint
+        cursor.execute(f"""
+        SELECT f.table_name, f.fingerprint
+        FROM {FINGERPRINT_TABLE} f
+        JOIN information_schema.tables t ON t.table_schema = DATABASE() AND t.table_name = f.table_name
+        WHERE f.fingerprint IS NOT NULL
+        """)
+        fingerprints = dict(cursor.fetchall())
+        cursor.execute(f"SELECT table_name, last_full_sync_at FROM {SYNC_STATE_TABLE} WHERE last_full_sync_at IS NOT NULL")
+        last_full_syncs = dict(cursor.fetchall())
+        connection.commit()
+        cursor.close()
+        return fingerprints, last_full_syncs
+    finally:
+        connection.close()
+
+
+def save_pending_fingerprint(cursor, table, fingerprint):
+    """Record the fingerprint of <table>_tmp, NULL when there is no copy waiting for rename_tmp.sh"""
+    cursor.execute(f"""
+    INSERT INTO {FINGERPRINT_TABLE} (table_name, pending_fingerprint) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE pending_fingerprint = VALUES(pending_fingerprint)
+    """, (table, fingerprint))
+
+
+def save_fingerprint(cursor, table, fingerprint):
+    """Record the fingerprint of a main table updated in place, which has no copy waiting for rename_tmp.sh"""
+    cursor.execute(f"""
+    INSERT INTO {FINGERPRINT_TABLE} (table_name, fingerprint, pending_fingerprint) VALUES (%s, %s, NULL)
+    ON DUPLICATE KEY UPDATE fingerprint = VALUES(fingerprint), pending_fingerprint = NULL
+    """, (table, fingerprint))
+
+
+def save_pending_full_sync(cursor, table, started_at):
+    """Record the start of a full resync of an incremental table, it becomes its last full resync once renamed"""
+    cursor.execute(f"""
+    INSERT INTO {SYNC_STATE_TABLE} (table_name, pending_full_sync_at) VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE pending_full_sync_at = VALUES(pending_full_sync_at)
+    """, (table, started_at))
+
+
+def acquire_slot(kind, connection_config, limit):
+    """Wait for one of the limit slots of kind ('export' or 'import') on the server of connection_config, and return
+    the connection holding it
+
+    A slot is a named lock of the server, held by a connection of its own. The server frees it if the connection
+    is lost, e.g. when its process dies
+    """
+    slot_count = max(1, limit)
+    connection = connect(connection_config)
+    cursor = connection.cursor()
+    try:
+        # A free slot is taken at once. Otherwise the worker blocks on the server for one slot at a time instead
+        # of polling them all, starting from a random slot so that the waiting workers spread over the slots
+        for index in range(slot_count):
+            cursor.execute("SELECT GET_LOCK(%s, 0)", (f"{SLOT_LOCK_PREFIX}_{kind}_{index}",))
+            if cursor.fetchone()[0] == 1:
+                cursor.close()
+                return connection
+
+        index = random.randrange(slot_count)
+        while True:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (f"{SLOT_LOCK_PREFIX}_{kind}_{index}", SLOT_WAIT_SECONDS))
+            if cursor.fetchone()[0] == 1:
+                cursor.close()
+                return connection
+            index = (index + 1) % slot_count
+    except BaseException:
+        connection.close()
+        raise
+
+
+def release_slot(slot):
+    """Free a slot returned by acquire_slot, releasing it more than once is harmless"""
+    if slot is not None and slot.is_connected():
+        # Closing the connection releases its named locks
+        slot.close()
+
+
+def stream_rows(source, target, target_cursor, select_query, params, insert_query, limits=None, export_slot=None,
+                batch_size=COPY_BATCH_SIZE):
+    """Stream the rows of a source query into batched inserts on the target, and return the number of rows
+
+    The rows are read in a thread of their own, so the export of the next batches overlaps with the import of
+    the previous ones. export_slot is freed as soon as the source rows are read, and the import holds an
+    import slot of limits while it writes
+    """
+    batches = queue.Queue(maxsize=STREAM_QUEUE_BATCHES)
+    stop_reading = threading.Event()
+
+    def read_batches():
+        # The source rows are streamed with an unbuffered cursor. Raw values are sent back as they were read,
+        # so nothing is converted to Python types and back
+        try:
+            rows_cursor = source.cursor(raw=True)
+            rows_cursor.execute(select_query, params)
+            while not stop_reading.is_set():
+                rows = rows_cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                batches.put(rows)
+            rows_cursor.close()
+            batches.put(None)
+        except Exception as error:
+            batches.put(error)
+        finally:
+            release_slot(export_slot)
+
+    reader = threading.Thread(target=read_batches, daemon=True)
+    reader.start()
+
+    import_slot = None
+    total_copied = 0
+    try:
+        # Taken inside the try, so that a failure to get it still stops the reader and frees its export slot
+        if limits is not None:
+            import_slot = acquire_slot('import', limits.import_config, limits.max_imports)
+        while True:
+            rows = batches.get()
+            if rows is None:
+                break
+            if isinstance(rows, Exception):
+                raise rows
+            target_cursor.executemany(insert_query, rows)
+            target.commit()
+            total_copied += len(rows)
+    finally:
+        release_slot(import_slot)
+        # A failed import stops the export, the batch it may be blocked on is taken out of its way
+        stop_reading.set()
+        while reader.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    return total_copied
+
+
+def can_merge(table, columns, indexes, fingerprint, current_fingerprint):
+    """Whether the changed rows of a table can be merged into its main table instead of copying the whole table
+
+    The main table must have the same definition as the source, and an id primary key to merge the rows on
+    """
+    if current_fingerprint is None or table not in INCREMENTAL_TABLES:
+        return False
+    if fingerprint.rsplit(';ddl=', 1)[1] != current_fingerprint.rsplit(';ddl=', 1)[-1]:
+        return False
+    primary_key = [index['column_name'] for index in indexes if index['index_name'] == 'PRIMARY']
+    return primary_key == ['id']
+
+
+def merge_changed_rows(source, target, target_cursor, table, columns, projection=None, merge_since=None,
+                       limits=None, export_slot=None, batch_size=COPY_BATCH_SIZE):
+    """Merge the source rows above the highest id of the main table, or updated since its latest updated_at,
+    into the main table, and return the number of merged rows
+
+    With a row predicate, the rows whose parent was updated since merge_since are merged as well
+    """
+    has_updated_at = any(column['column_name'] == 'updated_at' for column in columns)
+    max_updated_at = "MAX(`updated_at`)" if has_updated_at else "NULL"
+    target_cursor.execute(f"SELECT MAX(`id`), {max_updated_at} FROM {quote_name(table)}")
+    last_id, last_updated_at = target_cursor.fetchone()
+
+    changed_filter = "`id` > %s"
+    params = [last_id or 0]
+    if last_updated_at is not None:
+        # Merging a row again is harmless, the overlap only costs a few extra rows
+        changed_filter += " OR `updated_at` >= %s"
+        params.append(last_updated_at - SYNC_OVERLAP)
+    if projection is not None and 'parent' in projection:
+        # Rows that joined the slice since the last full resync, merged again on every run until the next one.
+        # Rows that left it stay until then, the ETLs filter them out themselves
+        parent = projection['parent']
+        changed_filter += (f" OR {quote_name(parent['column'])} IN "
+                           f"(SELECT `id` FROM {quote_name(parent['table'])} WHERE `updated_at` >= %s)")
+        params.append(merge_since - SYNC_OVERLAP)
+    if projection is not None and 'where' in projection:
+        changed_filter = f"({changed_filter}) AND ({projection['where']})"
+
+    copied_columns = [quote_name(column['column_name']) for column in columns if not is_generated(column)]
+    placeholders = ', '.join(['%s'] * len(copied_columns))
+    updates = ', '.join(f"{column} = VALUES({column})" for column in copied_columns if column != '`id`')
+    copied_columns = ', '.join(copied_columns)
+    insert_query = (f"INSERT INTO {quote_name(table)} ({copied_columns}) VALUES ({placeholders}) "
+                    f"ON DUPLICATE KEY UPDATE {updates}")
+
+    select_query = f"SELECT {copied_columns} FROM {quote_name(table)} WHERE {changed_filter}"
+    return stream_rows(source, target, target_cursor, select_query, tuple(params), insert_query, limits, export_slot,
+                       batch_size)
+
+
+def copy_table(source_config, target_config, table, current_fingerprint=None, skip_unchanged=True, merge_since=None,
+               projection=None, limits=None, batch_size=COPY_BATCH_SIZE, manifest_indexes=()):
+    """Recreate <table>_tmp in the target DB and stream the rows of the source table into it
+
+    Returns the way the table was processed with the number of rows:
+    ('skipped', 0) if the source table still has the current_fingerprint of the main table and skip_unchanged is set,
+    ('merged', rows) if only its changed rows were merged into the main table (incremental tables, with the time of
+    their last full resync as merge_since), ('copied', rows) otherwise.
+    projection is the manifest entry of the table, if any, and manifest_indexes its entries in the index manifest.
+    With limits, the reads from the source hold an export slot and the writes to the target an import slot
+    """
+    export_slot = acquire_slot('export', limits.export_config, limits.max_exports) if limits is not None else None
+    source = connect(source_config)
+    target = connect(target_config)
+    try:
+        source_cursor = source.cursor()
+        source_cursor.execute("SELECT VERSION()")
+        is_mariadb = 'mariadb' in source_cursor.fetchone()[0].lower()
+        columns, indexes = get_table_definition(source_cursor, source_config['database'], table)
+        if not columns:
+            raise ValueError(f"Table {table} doesn't exist in {source_config['database']}")
+        if projection is not None:
+            columns, indexes = project_table(table, columns, indexes, projection)
+        indexes = add_manifest_indexes(table, columns, indexes, manifest_indexes)
+
+        # Taken before the copy, a change made during the copy shows as a new fingerprint on the next run.
+        # A change of the table definition alone also makes a new copy
+        tmp_ddl = build_tmp_ddl(table, columns, indexes, is_mariadb)
+        fingerprint = table_fingerprint(source_cursor, table, columns, projection)
+        fingerprint += f";ddl={hashlib.md5(tmp_ddl.encode('utf-8')).hexdigest()}"
+        source_cursor.close()
+
+        target_cursor = target.cursor()
+        if skip_unchanged and fingerprint == current_fingerprint:
+            release_slot(export_slot)
+            # The main table is up to date, a leftover copy of a failed run must not be renamed over it
+            save_pending_fingerprint(target_cursor, table, None)
+            target.commit()
+            target_cursor.close()
+            return 'skipped', 0
+
+        if merge_since is not None and can_merge(table, columns, indexes, fingerprint, current_fingerprint):
+            # The main table is updated in place, its new fingerprint needs no rename
+            total_merged = merge_changed_rows(source, target, target_cursor, table, columns, projection, merge_since,
+                                              limits, export_slot, batch_size)
+            save_fingerprint(target_cursor, table, fingerprint)
+            target.commit()
+            target_cursor.close()
+            return 'merged', total_merged
+
+        full_sync_started_at = datetime.datetime.now()
+        target_cursor.execute(f"DROP TABLE IF EXISTS {quote_name(table + '_tmp')}")
+        target_cursor.execute(tmp_ddl)
+
+        # Generated columns are computed again by the target
+        copied_columns = [quote_name(column['column_name']) for column in columns if not is_generated(column)]
+        placeholders = ', '.join(['%s'] * len(copied_columns))
+        copied_columns = ', '.join(copied_columns)
+        insert_query = f"INSERT INTO {quote_name(table + '_tmp')} ({copied_columns}) VALUES ({placeholders})"
+
+        select_query = f"SELECT {copied_columns} FROM {quote_name(table)}"
+        if projection is not None and 'where' in projection:
+            select_query += f" WHERE {projection['where']}"
+
+        target_cursor.execute("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+        total_copied = stream_rows(source, target, target_cursor, select_query, None, insert_query, limits, export_slot,
+                                   batch_size)
+
+        # rename_tmp.sh only swaps in the tables with a pending fingerprint, and validates them first
+        save_pending_fingerprint(target_cursor, table, fingerprint)
+        if table in INCREMENTAL_TABLES:
+            save_pending_full_sync(target_cursor, table, full_sync_started_at)
+        target.commit()
+        target_cursor.close()
+        return 'copied', total_copied
+    finally:
+        release_slot(export_slot)
+        source.close()
+        target.close()
+
+
+def main(argv):
+    """Copy the given tables of a brand, and return a non-zero status if any of them failed"""
+    if len(argv) < 2:
+        print("Usage: copy_tables.py BRAND table [table ...]", file=sys.stderr)
+        return 1
+
+    brand, tables = argv[0], argv[1:]
+    source_config, target_config = get_db_details(brand)
+    workers = int(Variable.get('transfer_copy_workers', default_var=COPY_WORKERS))
+
+    # The exports from the CRM server and the imports into the target server are capped across all the brands
+    limits = SlotLimits(
+        source_config,
+        int(Variable.get('transfer_max_exports_per_host', default_var=MAX_EXPORTS_PER_HOST)),
+        target_config,
+        int(Variable.get('transfer_max_imports_per_host', default_var=MAX_IMPORTS_PER_HOST))
+    )
+
+    # Tables whose source hasn't changed since their last copy are skipped, unless transfer_skip_unchanged is 'false'
+    current_fingerprints, last_full_syncs = get_transfer_state(target_config)
+    skip_unchanged = str(Variable.get('transfer_skip_unchanged', default_var='true')).lower() == 'true'
+
+    # Incremental tables are fully copied again once their last full resync is too old
+    full_resync_interval = datetime.timedelta(hours=float(Variable.get('transfer_full_resync_hours', default_var=FULL_RESYNC_HOURS)))
+    now = datetime.datetime.now()
+
+    # Only the columns and rows the ETLs read are copied, unless transfer_use_manifest is 'false'
+    manifest = {}
+    if str(Variable.get('transfer_use_manifest', default_var='true')).lower() == 'true':
+        manifest = load_manifest()
+    manifest_indexes = load_manifest(INDEX_MANIFEST_PATH)['indexes']
+
+    def copy(table):
+        try:
+            merge_since = last_full_syncs.get(table)
+            if merge_since is not None and now - merge_since >= full_resync_interval:
+                merge_since = None
+            mode, total_rows = copy_table(source_config, target_config, table, current_fingerprints.get(table),
+                                          skip_unchanged, merge_since, manifest.get(table), limits,
+                                          manifest_indexes=manifest_indexes.get(table, ()))
+            if mode == 'skipped':
+                print(f"Skipped unchanged table: {table} for {brand}", flush=True)
+            elif mode == 'merged':
+                print(f"Merged {total_rows} new or updated rows into table: {table} for {brand}", flush=True)
+            else:
+                print(f"Successfully created table: {table}_tmp for {brand} ({total_rows} rows)", flush=True)
+            return True
+        except (mysql.connector.Error, ValueError) as error:
+            print(f"Failed to create table: {table}_tmp for {brand}: {error}", flush=True)
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(copy, tables))
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,31 @@
+"""
+Resolve Airflow Variables for the Bash scripts in a single Python process
+
+Usage: eval "$(python3 export_variables.py SHELL_NAME=variable_key [SHELL_NAME=variable_key ...])"
+
+Prints one shell assignment per variable, quoted so that the output can be passed to eval.
+"""
+
+import shlex
+import sys
+
+from airflow.models import Variable
+
+
+def main(assignments):
+    """Print a shell assignment for every SHELL_NAME=variable_key argument"""
+    lines = []
+    for assignment in assignments:
+        shell_name, separator, variable_key = assignment.partition('=')
+        if not separator or not shell_name.isidentifier() or not variable_key:
+            print(f"Invalid argument '{assignment}', expected SHELL_NAME=variable_key", file=sys.stderr)
+            return 1
+        lines.append(f"{shell_name}={shlex.quote(str(Variable.get(variable_key)))}")
+
+    # Nothing is printed unless every variable was resolved, so a failure can't leave half of them set
+    print('\n'.join(lines))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# Directory of this script, where export_variables.py is copied as well
+SCRIPT_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+
 # List of brands
 BRANDS=("ABC" "DEF" "GHI" "JKL" "MNO")
 
@@ -36,60 +39,125 @@ process_brand() {
     
     echo "Processing brand: $brand (Database: $db_name)"
 
-    # Target DB credentials
-    DB_TARGET_DB=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_name_${brand,,}'))" 2>/dev/null)
-    DB_TARGET_HOST=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_host'))" 2>/dev/null)
-    DB_TARGET_PORT=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_port'))" 2>/dev/null)
-    DB_TARGET_USER=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_user'))" 2>/dev/null)
-    DB_TARGET_PASSWORD=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_password'))" 2>/dev/null)
+    # Target DB credentials, retrieved from Airflow in one go
+    eval "$(python3 "${SCRIPT_DIR}/export_variables.py" \
+        DB_TARGET_DB="target_db_name_${brand,,}" \
+        DB_TARGET_HOST=target_db_host \
+        DB_TARGET_PORT=target_db_port \
+        DB_TARGET_USER=target_db_user \
+        DB_TARGET_PASSWORD=target_db_password 2>/dev/null)"
 
-    # Function to execute SQL commands
+    # Function to execute SQL commands, extra arguments are passed to the mysql client (e.g., -N)
     execute_sql() {
-        mysql -h "${DB_TARGET_HOST}" -P "${DB_TARGET_PORT}" -u "${DB_TARGET_USER}" -p"${DB_TARGET_PASSWORD}" "${DB_TARGET_DB}" -e "$1"
+        mysql -h "${DB_TARGET_HOST}" -P "${DB_TARGET_PORT}" -u "${DB_TARGET_USER}" -p"${DB_TARGET_PASSWORD}" "${@:2}" "${DB_TARGET_DB}" -e "$1"
     }
 
-    # Function to check if a table has data
-    table_has_data() {
-        local table_name=$1
-        local row_count=$(execute_sql "SELECT COUNT(*) FROM \`${table_name}\`;" | tail -n 1)
-        [ "$row_count" -gt 0 ]
+    # Function to join array elements
+    join() {
+        local IFS="$1"
+        shift
+        echo "$*"
     }
 
-    # Check if all temporary tables have data
-    all_tmp_tables_have_data() {
-        for table in "${TABLES[@]}"; do
-            if ! table_has_data "${table}_tmp"; then
-                echo "ERROR: Temporary table ${table}_tmp does not exist or is empty for $brand."
-                return 1
-            fi
-        done
+    # Tables copied by transfer.sh in this run, and the tables of the schema, in one session. Tables whose
+    # source didn't change were not copied, their main table is left as it is
+    local state
+    if ! state=$(execute_sql "SELECT 'pending', table_name FROM transfer_fingerprint WHERE pending_fingerprint IS NOT NULL
+        UNION ALL SELECT 'exists', table_name FROM information_schema.tables WHERE table_schema = DATABASE();" -N); then
+        echo "ERROR: Could not read the transfer state of $brand. Aborting the renaming process."
+        return 1
+    fi
+
+    local pending_tables=" " existing_tables=" "
+    while read -r kind table_name; do
+        if [ "$kind" == "pending" ]; then
+            pending_tables+="$table_name "
+        elif [ -n "$kind" ]; then
+            existing_tables+="$table_name "
+        fi
+    done <<< "$state"
+
+    local changed_tables=()
+    for table in "${TABLES[@]}"; do
+        if [[ "$pending_tables" == *" $table "* ]]; then
+            changed_tables+=("$table")
+        fi
+    done
+
+    if [ ${#changed_tables[@]} -eq 0 ]; then
+        echo "No table has changed since the last run for $brand. Nothing to rename."
         return 0
-    }
+    fi
+    echo "Changed tables for $brand: ${changed_tables[*]}"
 
-    # Main process for this brand
-    if all_tmp_tables_have_data; then
-        echo "All temporary tables exist and have data. Proceeding with renaming process for $brand."
-        
-        for table in "${TABLES[@]}"; do
-            echo "Processing table: $table for $brand"
-            
-            # Drop the main table
-            execute_sql "DROP TABLE IF EXISTS \`$table\`;"
-            echo "Dropped main table: $table"
-            
-            # Rename the temporary table to become the new main table
-            execute_sql "RENAME TABLE \`${table}_tmp\` TO \`$table\`;"
-            echo "Renamed ${table}_tmp to $table"
-            
-            echo "Completed processing table: $table for $brand"
-        done
-        
-        echo "Rename operation completed successfully for all tables in $brand."
-    else
-        echo "ERROR: Not all temporary tables exist or have data for $brand. Aborting the renaming process."
+    # Check that the temporary tables of the changed tables exist, from the schema listing
+    local missing_tables=()
+    for table in "${changed_tables[@]}"; do
+        if [[ "$existing_tables" != *" ${table}_tmp "* ]]; then
+            missing_tables+=("${table}_tmp")
+        fi
+    done
+    if [ ${#missing_tables[@]} -gt 0 ]; then
+        echo "ERROR: Temporary tables ${missing_tables[*]} do not exist for $brand. Aborting the renaming process."
         echo "No tables were renamed or dropped. Please check the temporary tables and try again."
         return 1
     fi
+
+    # Check that they have data, with one EXISTS probe per table in a single query, which stops at the first row
+    # instead of counting them all
+    local probes=()
+    for table in "${changed_tables[@]}"; do
+        probes+=("SELECT '${table}_tmp' FROM DUAL WHERE NOT EXISTS (SELECT 1 FROM \`${table}_tmp\`)")
+    done
+    local empty_tables
+    if ! empty_tables=$(execute_sql "$(join $'\n' "${probes[@]/%/ UNION ALL}") SELECT NULL FROM DUAL WHERE FALSE;" -N); then
+        echo "ERROR: Could not check the temporary tables for $brand. Aborting the renaming process."
+        return 1
+    fi
+    if [ -n "$empty_tables" ]; then
+        echo "ERROR: Temporary tables $(echo $empty_tables) are empty for $brand. Aborting the renaming process."
+        echo "No tables were renamed or dropped. Please check the temporary tables and try again."
+        return 1
+    fi
+
+    echo "All temporary tables exist and have data. Proceeding with renaming process for $brand."
+
+    # Swap all the changed tables with one atomic RENAME TABLE, readers see either all the old tables or all
+    # the new ones. The old tables are moved aside, and only dropped once the swap has succeeded. A main table
+    # that doesn't exist yet simply gets its temporary table renamed
+    local renames=() old_tables=() quoted_tables=()
+    for table in "${changed_tables[@]}"; do
+        if [[ "$existing_tables" == *" $table "* ]]; then
+            renames+=("\`$table\` TO \`${table}_old\`")
+            old_tables+=("\`${table}_old\`")
+        fi
+        renames+=("\`${table}_tmp\` TO \`$table\`")
+        quoted_tables+=("'$table'")
+    done
+
+    local drop_old=""
+    if [ ${#old_tables[@]} -gt 0 ]; then
+        drop_old="DROP TABLE IF EXISTS $(join , "${old_tables[@]}");"
+    fi
+
+    # The new main tables are validated, their fingerprints become the ones the next transfer compares against.
+    # For the incremental tables, the copy also becomes their last full resync. The mysql client stops at the
+    # first failing statement, so nothing after a failed swap is run
+    if ! execute_sql "${drop_old}
+        RENAME TABLE $(join , "${renames[@]}");
+        ${drop_old}
+        UPDATE transfer_fingerprint SET fingerprint = pending_fingerprint, pending_fingerprint = NULL
+            WHERE table_name IN ($(join , "${quoted_tables[@]}"));
+        UPDATE transfer_sync_state SET last_full_sync_at = pending_full_sync_at, pending_full_sync_at = NULL
+            WHERE table_name IN ($(join , "${quoted_tables[@]}")) AND pending_full_sync_at IS NOT NULL;"; then
+        echo "ERROR: Renaming the temporary tables failed for $brand."
+        return 1
+    fi
+
+    for table in "${changed_tables[@]}"; do
+        echo "Renamed ${table}_tmp to $table"
+    done
+    echo "Rename operation completed successfully for all changed tables in $brand."
 }
 
 # Individual brand functions
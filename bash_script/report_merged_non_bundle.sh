@@ -1,11 +1,15 @@
 #!/bin/bash
 
-# Target DB credentials
+# Directory of this script, where export_variables.py is copied as well
+SCRIPT_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+
+# Target DB credentials, retrieved from Airflow in one go
 DB_TARGET_DB=stock_reports
-DB_TARGET_HOST=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_host'))" 2>/dev/null)
-DB_TARGET_PORT=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_port'))" 2>/dev/null)
-DB_TARGET_USER=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_user'))" 2>/dev/null)
-DB_TARGET_PASSWORD=$(python3 -c "from airflow.models import Variable; print(Variable.get('target_db_password'))" 2>/dev/null)
+eval "$(python3 "${SCRIPT_DIR}/export_variables.py" \
+    DB_TARGET_HOST=target_db_host \
+    DB_TARGET_PORT=target_db_port \
+    DB_TARGET_USER=target_db_user \
+    DB_TARGET_PASSWORD=target_db_password 2>/dev/null)"
 
 
 # Function to execute SQL commands
@@ -0,0 +1,118 @@
+"""
+Per-brand context of the ETL runs, and a runner processing several brands at once
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+# In a cross-brand batch the brand index is stored in the high bits of the ids, the ids of a brand stay below 2**40
+BRAND_KEY_SHIFT = 40
+
+# Separator between the brand index and the value of the string keys in a cross-brand batch
+BRAND_KEY_SEPARATOR = '\x1f'
+
+
+@dataclass
+class BrandContext:
+    """Configuration and intermediate frames of one brand's ETL run"""
+    brand: str
+    # Connection settings (database, user, password, host, port) of the source and target databases,
+    # left out of the repr so that credentials don't end up in the logs
+    source_config: dict = field(repr=False)
+    target_config: dict = field(repr=False)
+    # Intermediate frames of the run, kept for inspection (e.g., frames['reporting_df'])
+    frames: dict = field(default_factory=dict, repr=False)
+    # Values carried from one step of the run to the next (e.g., the new watermark)
+    state: dict = field(default_factory=dict, repr=False)
+
+
+# Outcome of one brand in run_brands: the return value of the brand function, or the exception it raised
+BrandResult = namedtuple('BrandResult', ['brand', 'result', 'error'])
+
+
+def run_brands(run_brand, brands, max_workers=None, use_processes=True):
+    """Run run_brand(brand) for several brands at once, and return a BrandResult per brand
+
+    With use_processes the brands run in a process pool, so their transforms don't share the GIL.
+    run_brand must then be a module-level function with a picklable return value
+    """
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    results = {}
+    with executor_class(max_workers=max_workers or len(brands)) as executor:
+        futures = {brand: executor.submit(run_brand, brand) for brand in brands}
+
+        # A failing brand doesn't stop the others, its error is reported in its result
+        for brand, future in futures.items():
+            try:
+                results[brand] = BrandResult(brand, future.result(), None)
+            except Exception as error:
+                print(f"An error occurred during the ETL process for {brand}: {str(error)}")
+                results[brand] = BrandResult(brand, None, error)
+    return results
+
+
+def run_batched(run_batch, brands):
+    """Run run_batch(brands) once for all the brands, and return a BrandResult per brand as run_brands does
+
+    The brands of a batch share one transform, an error of the batch is the error of every brand
+    """
+    try:
+        outputs = run_batch(brands)
+    except Exception as error:
+        print(f"An error occurred during the batched ETL process for {', '.join(brands)}: {str(error)}")
+        return {brand: BrandResult(brand, None, error) for brand in brands}
+    return {brand: BrandResult(brand, outputs[brand], None) for brand in brands}
+
+
+def encode_brand_ids(ids, brand_index):
+    """Put the brand index in the high bits of the ids, so that the ids of different brands never collide"""
+    return ids + (brand_index << BRAND_KEY_SHIFT)
+
+
+def decode_brand_ids(ids):
+    """Split ids encoded with encode_brand_ids into the brand index and the original ids"""
+    brand_index = ids // (1 << BRAND_KEY_SHIFT)
+    return brand_index, ids - brand_index * (1 << BRAND_KEY_SHIFT)
+
+
+def stack_brand_frames(frames, id_columns, string_key_columns=()):
+    """Stack the frames of several brands (in brand index order) with the brand encoded in their key columns
+
+    Ids and string keys of different brands can't match, so groupbys, merges and sorts on them keep the
+    brands apart, and keep the order of each brand's rows the same as in a run of that brand alone
+    """
+    parts = []
+    for brand_index, df in enumerate(frames):
+        if df.empty:
+            continue
+        df = df.copy()
+        for column in id_columns:
+            df[column] = encode_brand_ids(df[column], brand_index)
+        for column in string_key_columns:
+            # Missing keys stay missing, they are dropped by groupbys as before
+            df[column] = (f"{brand_index}{BRAND_KEY_SEPARATOR}" + df[column]).where(df[column].notna(), df[column])
+        parts.append(df)
+
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True)
+
+
+def split_brand_frame(df, brand_column, brand_count, id_columns, string_key_columns=()):
+    """Split a frame built from stack_brand_frames back into one frame per brand, with the original keys"""
+    brand_index = decode_brand_ids(df[brand_column].to_numpy())[0] if not df.empty else np.array([])
+
+    frames = []
+    for index in range(brand_count):
+        part = df[brand_index == index].reset_index(drop=True)
+        for column in id_columns:
+            part[column] = decode_brand_ids(part[column])[1]
+        prefix_length = len(f"{index}{BRAND_KEY_SEPARATOR}")
+        for column in string_key_columns:
+            part[column] = part[column].str[prefix_length:].where(part[column].notna(), part[column])
+        frames.append(part)
+    return frames
@@ -0,0 +1,413 @@
+"""
+Shared MySQL helpers for the ETL scripts
+"""
+
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+import pandas as pd
+
+from airflow.models import Variable
+
+# Seconds an Airflow Variable is cached before it is read from the metadata DB again
+VARIABLE_CACHE_TTL = 300
+
+# Maximum number of connections opened by the pool of each (host, port, database), they are opened on demand,
+# so a pool only holds as many connections as were in use at once
+POOL_SIZE = 16
+
+# Seconds to wait for a free connection when the pool is exhausted
+POOL_WAIT_TIMEOUT = 600
+
+# Number of rows fetched from the server at once when streaming a query result
+FETCH_BATCH_SIZE = 50000
+
+# Number of rows serialized at once when writing the LOAD DATA file
+INFILE_BATCH_SIZE = 100000
+
+# Default number of connections loading chunks of one table concurrently
+LOAD_PARALLELISM = 4
+
+# Number of rows loaded by one task of a parallel load
+PARALLEL_LOAD_ROWS = 100000
+
+# MySQL error codes meaning LOAD DATA LOCAL INFILE is disabled on the server or on the client:
+# ER_NOT_ALLOWED_COMMAND, CR_LOAD_DATA_LOCAL_INFILE_REJECTED, ER_CLIENT_LOCAL_FILES_DISABLED
+LOCAL_INFILE_DISABLED_ERRORS = {1148, 2068, 3948}
+
+# Characters escaped in the LOAD DATA file, with the default ESCAPED BY '\\'
+INFILE_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+
+_NO_DEFAULT = object()
+_variable_cache = {}
+_variable_cache_lock = threading.Lock()
+
+
+def get_variable(key, default_var=_NO_DEFAULT):
+    """Get an Airflow Variable, cached for VARIABLE_CACHE_TTL seconds so that a run doesn't read it again"""
+    now = time.monotonic()
+    with _variable_cache_lock:
+        cached = _variable_cache.get(key)
+    if cached is not None and now - cached[1] < VARIABLE_CACHE_TTL:
+        return cached[0]
+
+    if default_var is _NO_DEFAULT:
+        value = Variable.get(key)
+    else:
+        value = Variable.get(key, default_var=default_var)
+
+    with _variable_cache_lock:
+        _variable_cache[key] = (value, now)
+    return value
+
+
+class ConnectionPool:
+    """Connections to one database, opened on demand up to size and reused once handed back"""
+
+    def __init__(self, connection_config, size=POOL_SIZE):
+        # Pooled connections can also be used by the bulk loads, which need local infile
+        self.connection_config = dict(connection_config, allow_local_infile=True)
+        self.size = size
+        self.idle = deque()
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def get_connection(self, timeout=POOL_WAIT_TIMEOUT):
+        """Borrow an idle connection, or open a new one while fewer than size are open, waiting up to timeout"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not self.idle and self.opened >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise mysql.connector.errors.PoolError(f"No connection available after {timeout} seconds")
+                self.condition.wait(remaining)
+            connection = self.idle.pop() if self.idle else None
+            if connection is None:
+                self.opened += 1
+
+        try:
+            if connection is None:
+                connection = mysql.connector.connect(**self.connection_config)
+            elif not connection.is_connected():
+                # An idle connection may have been closed by the server in the meantime
+                connection.reconnect()
+        except Exception:
+            self.discard()
+            raise
+        return PooledConnection(self, connection)
+
+    def put(self, connection):
+        """Take back a borrowed connection, with its session reset for the next borrower"""
+        try:
+            connection.reset_session()
+        except mysql.connector.Error:
+            connection.close()
+            self.discard()
+            return
+        with self.condition:
+            self.idle.append(connection)
+            self.condition.notify()
+
+    def discard(self):
+        """Forget a connection that couldn't be opened or reused, so that another one can be opened"""
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+
+class PooledConnection:
+    """A connection borrowed from a ConnectionPool, closing it hands it back to the pool"""
+
+    def __init__(self, pool, connection):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_connection', connection)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+    def close(self):
+        connection = self._connection
+        if connection is not None:
+            object.__setattr__(self, '_connection', None)
+            self._pool.put(connection)
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(connection_config):
+    """Get the connection pool of the (host, port, database) of connection_config, created on first use"""
+    global _pools_pid
+    key = (connection_config['host'], int(connection_config['port']), connection_config['database'])
+
+    with _pools_lock:
+        # Connections inherited from a parent process can't be shared, a forked worker builds its own pools
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(connection_config)
+            _pools[key] = pool
+        return pool
+
+
+def get_connection(connection_config, timeout=POOL_WAIT_TIMEOUT):
+    """Get a warm connection from the pool of connection_config, opening one if none is idle and the pool isn't full
+
+    Closing the connection hands it back to the pool
+    """
+    return get_pool(connection_config).get_connection(timeout)
+
+
+def iter_query_batches(connection, query, params=None, batch_size=FETCH_BATCH_SIZE):
+    """Run a query on an unbuffered cursor and yield the result as DataFrames of at most batch_size rows"""
+    # An unbuffered cursor streams the rows from the server as they are fetched,
+    # so only one batch of raw rows is held in Python at a time
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            # Each batch is turned into typed columns right away, the raw row tuples are released
+            yield pd.DataFrame.from_records(rows, columns=columns)
+    finally:
+        cursor.close()
+
+
+def read_query(connection, query, params=None, batch_size=FETCH_BATCH_SIZE):
+    """Run a query and build a single DataFrame from the streamed batches, one column at a time"""
+    # Each batch is split into columns of their own and released, then each column is concatenated and its
+    # pieces released before the next one. Only one column is held twice, not the whole result
+    columns = None
+    column_pieces = None
+    for batch in iter_query_batches(connection, query, params, batch_size):
+        if columns is None:
+            columns = list(batch.columns)
+            column_pieces = [[] for _ in columns]
+        for position, pieces in enumerate(column_pieces):
+            pieces.append(batch.iloc[:, position].copy())
+        del batch
+
+    if columns is None:
+        return pd.DataFrame()
+
+    df = None
+    for position, column in enumerate(columns):
+        values = pd.concat(column_pieces[position], ignore_index=True)
+        column_pieces[position] = None
+        # A batch where a column is only NULL is typed as object. Re-infer those columns, so that the
+        # result gets the same dtypes as a DataFrame built from the whole result at once
+        if values.dtype == object:
+            values = values.infer_objects()
+        if df is None:
+            df = pd.DataFrame(index=values.index)
+        df.insert(position, column, values, allow_duplicates=True)
+
+    return df
+
+
+def delete_by_ids(cursor, table, column, ids, chunk_size=7000):
+    """Delete the rows of a table whose column is one of the given ids, in chunks, and return the number of deleted rows"""
+    ids = [int(row_id) for row_id in ids]
+    total_deleted = 0
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({placeholders})", chunk)
+        total_deleted += cursor.rowcount
+    return total_deleted
+
+
+def to_infile_values(values):
+    """Convert a column to the text of a LOAD DATA file: NULL as \\N, datetimes in MySQL format, escaped strings"""
+    is_null = values.isna()
+
+    if pd.api.types.is_datetime64_any_dtype(values):
+        text = values.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    elif pd.api.types.is_bool_dtype(values) or pd.api.types.infer_dtype(values, skipna=True) == 'boolean':
+        text = values.map({True: '1', False: '0'})
+    elif pd.api.types.is_numeric_dtype(values):
+        text = values.astype(str)
+    else:
+        text = values.astype(str).str.translate(INFILE_ESCAPES)
+
+    return text.where(~is_null, '\\N')
+
+
+def write_infile(df, file):
+    """Write the rows of df to a tab-separated LOAD DATA file, in batches"""
+    for start in range(0, len(df), INFILE_BATCH_SIZE):
+        batch = df.iloc[start:start + INFILE_BATCH_SIZE]
+        columns = [to_infile_values(batch[column]).reset_index(drop=True) for column in batch.columns]
+        lines = columns[0].str.cat(columns[1:], sep='\t') if len(columns) > 1 else columns[0]
+        file.write('\n'.join(lines))
+        file.write('\n')
+
+
+def load_data_infile(cursor, table, df):
+    """Insert the rows of df into table with LOAD DATA LOCAL INFILE, and return the number of inserted rows"""
+    # mysql.connector only reads LOAD DATA LOCAL from a file, so the rows are spooled to a temporary file
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.tsv', delete=False) as file:
+        infile_path = file.name
+        write_infile(df, file)
+
+    try:
+        columns_list_str = ', '.join(f"`{col}`" for col in df.columns)
+        cursor.execute(f"""
+        LOAD DATA LOCAL INFILE %s INTO TABLE {table}
+        CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+        LINES TERMINATED BY '\\n'
+        ({columns_list_str})
+        """, (infile_path,))
+        total_inserted = cursor.rowcount
+
+        # With LOCAL, duplicate keys are skipped and bad values coerced with only a warning. They fail the load
+        # as they fail executemany, so that the caller rolls back instead of committing or swapping altered rows
+        warning_count = cursor.warning_count
+        if warning_count or total_inserted != len(df):
+            cursor.execute("SHOW WARNINGS LIMIT 10")
+            warnings = '; '.join(f"{level} {code}: {message}" for level, code, message in cursor.fetchall())
+            raise mysql.connector.errors.DataError(
+                msg=f"LOAD DATA inserted {total_inserted} of {len(df)} row(s) into '{table}' "
+                    f"with {warning_count} warning(s): {warnings}"
+            )
+
+        return total_inserted
+    finally:
+        os.remove(infile_path)
+
+
+def insert_with_executemany(cursor, table, df, chunk_size=7000):
+    """Insert the rows of df into table with executemany in chunks, and return the number of inserted rows"""
+    columns_list_str = ', '.join(f"`{col}`" for col in df.columns)
+    placeholders = ', '.join(['%s'] * len(df.columns))
+    insert_query = f"INSERT INTO {table} ({columns_list_str}) VALUES ({placeholders})"
+
+    # NaN and NaT can't be sent to MySQL, they become NULL
+    values = df.astype(object).where(df.notna(), None)
+
+    total_inserted = 0
+    for start in range(0, len(values), chunk_size):
+        chunk = list(values.iloc[start:start + chunk_size].itertuples(index=False, name=None))
+        cursor.executemany(insert_query, chunk)
+        total_inserted += len(chunk)
+        print(f"Inserted {total_inserted}/{len(values)} rows so far...")
+    return total_inserted
+
+
+def bulk_insert(cursor, table, df, chunk_size=7000):
+    """Insert the rows of df into table with LOAD DATA LOCAL INFILE, or with executemany if local infile is disabled"""
+    if df.empty:
+        return 0
+
+    try:
+        return load_data_infile(cursor, table, df)
+    except mysql.connector.Error as error:
+        if error.errno not in LOCAL_INFILE_DISABLED_ERRORS:
+            raise
+        print(f"LOAD DATA LOCAL INFILE is not available ({error}), falling back to executemany.")
+        return insert_with_executemany(cursor, table, df, chunk_size)
+
+
+def parallel_bulk_insert(connection_config, table, df, chunk_size=7000, parallelism=LOAD_PARALLELISM,
+                         rows_per_task=PARALLEL_LOAD_ROWS):
+    """Insert the rows of df into table in chunks spread over at most parallelism pooled connections, and return the number of inserted rows
+
+    Every chunk is committed on its own connection, so this is meant for tables that readers don't see
+    during the load, like a shadow table
+    """
+    if df.empty:
+        return 0
+
+    starts = range(0, len(df), rows_per_task)
+
+    def insert_chunk(start):
+        # Each worker borrows a connection from the pool for one chunk and hands it back afterwards
+        connection = get_connection(connection_config)
+        try:
+            connection.autocommit = False
+            cursor = connection.cursor()
+            try:
+                inserted = bulk_insert(cursor, table, df.iloc[start:start + rows_per_task], chunk_size)
+                connection.commit()
+            finally:
+                cursor.close()
+            return inserted
+        except mysql.connector.Error:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    total_inserted = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(starts)))) as executor:
+        for inserted in executor.map(insert_chunk, starts):
+            total_inserted += inserted
+            print(f"Inserted {total_inserted}/{len(df)} rows into '{table}' so far...")
+    return total_inserted
+
+
+def create_shadow_table(cursor, table):
+    """Create an empty shadow copy of a table with the same definition, and return its name"""
+    shadow_table = f"{table}_shadow"
+    # A shadow table left behind by a failed run is dropped first
+    cursor.execute(f"DROP TABLE IF EXISTS {shadow_table}")
+    cursor.execute(f"CREATE TABLE {shadow_table} LIKE {table}")
+    return shadow_table
+
+
+def swap_shadow_table(cursor, table):
+    """Swap the loaded shadow copy in place of a table with one atomic RENAME TABLE, then drop the old table"""
+    shadow_table = f"{table}_shadow"
+    old_table = f"{table}_old"
+    cursor.execute(f"DROP TABLE IF EXISTS {old_table}")
+    # Readers see either the old or the new table, never an empty or half-filled one
+    cursor.execute(f"RENAME TABLE {table} TO {old_table}, {shadow_table} TO {table}")
+    cursor.execute(f"DROP TABLE {old_table}")
+
+
+def replace_table_rows(connection_config, table, df, chunk_size=7000, use_shadow_table=True,
+                       parallelism=LOAD_PARALLELISM):
+    """Replace all the rows of a table with df over parallelism connections, and return the number of inserted rows
+
+    The rows fill a shadow copy swapped in at the end, so that readers keep querying the current table during
+    the load. Without use_shadow_table, the table is truncated and filled in place
+    """
+    connection = get_connection(connection_config)
+    try:
+        cursor = connection.cursor()
+        if use_shadow_table:
+            load_table = create_shadow_table(cursor, table)
+            print(f"Shadow table '{load_table}' has been created.")
+        else:
+            cursor.execute(f"TRUNCATE TABLE {table}")
+            load_table = table
+            print(f"Table '{table}' has been truncated.")
+
+        total_inserted = parallel_bulk_insert(connection_config, load_table, df, chunk_size, parallelism)
+
+        if use_shadow_table:
+            swap_shadow_table(cursor, table)
+            print(f"Table '{table}' has been swapped with its shadow copy.")
+        cursor.close()
+    finally:
+        connection.close()
+    return total_inserted
@@ -2,11 +2,14 @@
 Script to process retention_table and sunset_table
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
 import mysql.connector
 import pandas as pd
 
-# Load environment variables from Airflow
-from airflow.models import Variable
+from brand_runner import BrandContext, run_batched, run_brands, split_brand_frame, stack_brand_frames
+from db_utils import LOAD_PARALLELISM, get_connection, get_variable, read_query, replace_table_rows
 
 # List of all brands
 BRANDS = ['ABC', 'DEF', 'GHI', 'JKL', 'MNO']
@@ -14,59 +17,150 @@ BRANDS = ['ABC', 'DEF', 'GHI', 'JKL', 'MNO']
 def get_target_db_details(brand):
     """Get target database details for the given brand"""
     return {
-        'database': Variable.get(f'target_db_name_{brand.lower()}'),
-        'user': Variable.get('target_db_user'),
-        'password': Variable.get('target_db_password'),
-        'host': Variable.get('target_db_host'),
-        'port': Variable.get('target_db_port')
+        'database': get_variable(f'target_db_name_{brand.lower()}'),
+        'user': get_variable('target_db_user'),
+        'password': get_variable('target_db_password'),
+        'host': get_variable('target_db_host'),
+        'port': get_variable('target_db_port')
     }
 
-def extract():
-    """Extract required data"""
+def create_brand_context(brand):
+    """Build the context of a brand run, the brand database is both the source and the target"""
+    db_details = get_target_db_details(brand)
+    return BrandContext(brand, db_details, db_details)
+
+# Orders the retention and sunset tables are built from
+ORDERS_FILTER = """so.state IN ('fulfilled', 'new')
+    AND so.payment_state IN ('paid', 'partially_refunded', 'refunded')
+    AND so.total > 0"""
+
+# Queries of the extract, checked against the transfer manifest by transfer_manifest.py
+ORDERS_QUERY = f"""
+    SELECT 
+        so.id, so.customer_id, so.created_at, so.state, so.is_subscription,
+        so.created_from_order_id,
+        sc.email
+    FROM sylius_order so
+    LEFT JOIN sylius_customer sc ON so.customer_id = sc.id
+    WHERE {ORDERS_FILTER}
+"""
+
+# An item has one row per translation of its product, the rows of an item are ranked by translation id
+ITEMS_QUERY = """
+    SELECT 
+        soi.order_id, soi.id, 
+        COALESCE(NULLIF(soi.product_name, ''), spt.name) as product_name,
+        soi.variant_name, soi.quantity,
+        sp.id as product_id,
+        spt.id as translation_id
+    FROM sylius_order_item soi
+    JOIN sylius_product_variant spv ON soi.variant_id = spv.id
+    JOIN sylius_product sp ON spv.product_id = sp.id
+    LEFT JOIN sylius_product_translation spt ON sp.id = spt.translatable_id
+"""
+
+# Same rows as rank_order_items(ITEMS_QUERY rows, ORDERS_QUERY ids), ranked by MySQL 8 window functions, so that
+# only the item rows of the extracted orders that the retention and sunset tables read are sent. Names are compared
+# as bytes, as pandas does, not with the case and accent insensitive collation of the column
+RANKED_ITEMS_QUERY = f"""
+    SELECT
+        order_id, id, product_name, variant_name, quantity, product_id, rn, total_items_count,
+        first_item_repeated, first_product_repeated
+    FROM (
+        SELECT
+            firsts.*,
+            MAX(
+                id <> first_item_id AND CAST(product_name AS BINARY) <=> CAST(first_item_name AS BINARY)
+            ) OVER w_order AS first_item_repeated,
+            COALESCE(
+                SUM(CAST(product_name AS BINARY) = CAST(first_product_name AS BINARY)) OVER w_order, 0
+            ) > 1 AS first_product_repeated
+        FROM (
+            SELECT
+                ranked.*,
+                FIRST_VALUE(id) OVER (PARTITION BY order_id ORDER BY rn) AS first_item_id,
+                FIRST_VALUE(product_name) OVER (PARTITION BY order_id ORDER BY rn) AS first_item_name,
+                FIRST_VALUE(product_name) OVER (PARTITION BY order_id ORDER BY product_name IS NULL, rn) AS first_product_name,
+                MIN(CASE WHEN product_name IS NOT NULL THEN rn END) OVER w_order AS product_name_rn,
+                MIN(CASE WHEN variant_name IS NOT NULL THEN rn END) OVER w_order AS variant_name_rn,
+                MIN(CASE WHEN quantity IS NOT NULL THEN rn END) OVER w_order AS quantity_rn
+            FROM (
+                SELECT
+                    soi.order_id, soi.id,
+                    COALESCE(NULLIF(soi.product_name, ''), spt.name) AS product_name,
+                    soi.variant_name, soi.quantity,
+                    sp.id AS product_id,
+                    ROW_NUMBER() OVER (PARTITION BY soi.order_id ORDER BY soi.id, spt.id) AS rn,
+                    COUNT(*) OVER (PARTITION BY soi.order_id) AS total_items_count
+                FROM sylius_order_item soi
+                JOIN sylius_product_variant spv ON soi.variant_id = spv.id
+                JOIN sylius_product sp ON spv.product_id = sp.id
+                LEFT JOIN sylius_product_translation spt ON sp.id = spt.translatable_id
+                WHERE soi.order_id IN (SELECT so.id FROM sylius_order so WHERE {ORDERS_FILTER})
+            ) ranked
+            WINDOW w_order AS (PARTITION BY order_id)
+        ) firsts
+        WINDOW w_order AS (PARTITION BY order_id)
+    ) flagged
+    WHERE rn <= 2 OR rn IN (product_name_rn, variant_name_rn, quantity_rn)
+    ORDER BY order_id, rn
+"""
+
+def rank_order_items(items_df, order_ids):
+    """Rank the item rows of the given orders, and keep the first two and the first complete row of each order"""
+    items = items_df[items_df['order_id'].isin(order_ids)]
+    items = items.sort_values(['order_id', 'id', 'translation_id'], kind='stable').drop(columns='translation_id')
+    items = items.reset_index(drop=True)
+
+    item_orders = items['order_id']
+    grouped = items.groupby('order_id', sort=False)
+    items['rn'] = grouped.cumcount() + 1
+    items['total_items_count'] = grouped['id'].transform('size')
+
+    # Another item of the order with the same name as the first row, missing names being the same name
+    first_rows = items[items['rn'] == 1].set_index('order_id')
+    first_item_id = item_orders.map(first_rows['id'])
+    first_item_name = item_orders.map(first_rows['product_name'])
+    same_name = (items['product_name'] == first_item_name) | (items['product_name'].isna() & first_item_name.isna())
+    items['first_item_repeated'] = ((items['id'] != first_item_id) & same_name).groupby(item_orders).transform('any')
+
+    # Rows with the first non-empty product name of the order
+    first_product_name = grouped['product_name'].transform('first')
+    items['first_product_repeated'] = (items['product_name'] == first_product_name).groupby(item_orders).transform('sum') > 1
+
+    keep = items['rn'] <= 2
+    for column in ['product_name', 'variant_name', 'quantity']:
+        keep |= items['rn'] == items['rn'].where(items[column].notna()).groupby(item_orders).transform('min')
+    return items[keep].reset_index(drop=True)
+
+def use_pushdown_mode():
+    """Whether the items are ranked by MySQL window functions instead of pandas (Variable etl_retention_pushdown)"""
+    return str(get_variable("etl_retention_pushdown", default_var='false')).lower() == 'true'
+
+def use_batched_mode():
+    """Whether run_all_brands transforms the brands together with run_etl_batched (Variable etl_retention_batched)"""
+    return str(get_variable("etl_retention_batched", default_var='false')).lower() == 'true'
+
+def extract(context, pushdown=False):
+    """Extract required data, with the item rows ranked per order by rank_order_items
+
+    With pushdown the ranking runs in MySQL (8.0 or later), which only sends the ranked rows
+    """
     try:
-        connection = mysql.connector.connect(
-            database=source_crm_db_name,
-            user=target_db_user,
-            password=target_db_password,
-            host=target_db_host,
-            port=target_db_port
-        )
+        connection = get_connection(context.source_config)
         print("Connected to MySQL successfully for retention data extraction")
-        cursor = connection.cursor(dictionary=True)
 
         # Query for orders
-        orders_query = """
-            SELECT 
-                so.id, so.customer_id, so.created_at, so.state, so.is_subscription,
-                so.created_from_order_id,
-                sc.email
-            FROM sylius_order so
-            LEFT JOIN sylius_customer sc ON so.customer_id = sc.id
-            WHERE so.state IN ('fulfilled', 'new')
-            AND so.payment_state IN ('paid', 'partially_refunded', 'refunded')
-            AND so.total > 0
-        """
-        cursor.execute(orders_query)
-        orders_results = cursor.fetchall()
-        orders_df = pd.DataFrame(orders_results)
+        orders_df = read_query(connection, ORDERS_QUERY)
 
         # Query for order items
-        items_query = """
-            SELECT 
-                soi.order_id, soi.id, 
-                COALESCE(NULLIF(soi.product_name, ''), spt.name) as product_name,
-                soi.variant_name, soi.quantity,
-                sp.id as product_id
-            FROM sylius_order_item soi
-            JOIN sylius_product_variant spv ON soi.variant_id = spv.id
-            JOIN sylius_product sp ON spv.product_id = sp.id
-            LEFT JOIN sylius_product_translation spt ON sp.id = spt.translatable_id
-        """
-        cursor.execute(items_query)
-        items_results = cursor.fetchall()
-        items_df = pd.DataFrame(items_results)
-
-        cursor.close()
+        if pushdown:
+            items_df = read_query(connection, RANKED_ITEMS_QUERY)
+            flag_columns = ['first_item_repeated', 'first_product_repeated']
+            items_df[flag_columns] = items_df[flag_columns].astype(bool)
+        else:
+            items_df = rank_order_items(read_query(connection, ITEMS_QUERY), orders_df['id'])
+
         connection.close()
 
         return {
@@ -76,85 +170,93 @@ def extract():
 
     except mysql.connector.Error as error:
         print(f"Error while connecting to MySQL: {error}")
+        if 'connection' in locals():
+            connection.close()
         return {
             'orders': pd.DataFrame(),
             'order_items': pd.DataFrame()
         }
 
-def optimize_check_same_product(retention_df, items_df, first_items):
+def optimize_check_same_product(retention_df, first_items):
     """Vectorized implementation of checking for same product purchases"""
-    # Create a mapping of first items
-    first_items_map = first_items[['order_id', 'product_name', 'id']].copy()
-    
-    # Merge with items to find duplicates
-    merged = items_df.merge(
-        first_items_map, 
-        on=['order_id', 'product_name'], 
-        suffixes=('', '_first')
-    )
-    
-    # Find orders with same product
-    orders_with_same = merged[
-        merged['id'] != merged['id_first']
-    ]['order_id'].unique()
+    # Orders where another item has the product of the first item, flagged by rank_order_items
+    orders_with_same = first_items[first_items['first_item_repeated']]['order_id'].unique()
     
     return retention_df['first_order_id'].isin(orders_with_same)
 
-def get_second_orders_bulk(orders_df, emails):
-    """Get second orders efficiently for all customers"""
-    # Filter orders for relevant customers
-    customer_orders = orders_df[
-        (orders_df['email'].isin(emails)) & 
-        (orders_df['state'].isin(['fulfilled', 'new']))
-    ].copy()
-    
-    # Sort orders for each customer
-    customer_orders.sort_values(['email', 'created_at', 'id'], inplace=True)
-    
-    # Get second order for each customer
-    second_orders = customer_orders.groupby('email').nth(1)
-    
-    return second_orders
+def build_cohort_index(dfs):
+    """Index the orders and the retention and sunset cohorts of every customer once, as {'orders', 'customers'}"""
+    orders = dfs['orders'].copy()
+    items = dfs['order_items']
+    orders['id'] = orders['id'].astype(int)
+    orders['customer_id'] = orders['customer_id'].astype(int)
+
+    item_counts = items.groupby('order_id')['total_items_count'].first()
+    orders['item_count'] = orders['id'].map(item_counts).fillna(0).astype(int)
+    is_valid = orders['state'].isin(['fulfilled', 'new'])
+    is_sunset = is_valid & ~orders['is_subscription'] & orders['created_from_order_id'].isna()
+
+    # The only sort: the fulfilled or new orders of each email in the order they were placed
+    sequenced = orders[is_valid & orders['email'].notna()].sort_values(['email', 'created_at', 'id'])
+    orders['order_seq'] = sequenced.groupby('email').cumcount()
+    orders['sunset_seq'] = orders[is_sunset].groupby('customer_id')['id'].rank(method='first') - 1
+
+    # Retention cohort, the aggregates keep the 'first' customer_id of an email in extract order
+    members = orders[is_valid & (orders['item_count'] > 0)]
+    customers = members.groupby('email').agg(
+        first_order_id=('id', 'min'),
+        first_order_date=('created_at', 'min'),
+        customer_id=('customer_id', 'first')
+    )
+    customers['order_count'] = orders[is_valid].groupby('email').size()
+    customers['second_order_id'] = orders[orders['order_seq'] == 1].set_index('email')['id']
+    customers['first_order_item_count'] = customers['first_order_id'].map(orders.set_index('id')['item_count'])
+
+    # Sunset cohort, its second order is the one of the customer_id of the email's first order
+    sunset_members = orders[is_sunset]
+    sunset = sunset_members.groupby('email').agg(
+        sunset_first_order_id=('id', 'min'),
+        sunset_first_order_date=('created_at', 'min'),
+        sunset_customer_id=('customer_id', 'first')
+    )
+    sunset['sunset_order_count'] = orders.groupby('email').size()
+    second_orders = sunset_members[sunset_members['sunset_seq'] == 1].set_index('customer_id')
+    sunset['sunset_second_order_id'] = sunset['sunset_customer_id'].map(second_orders['id'])
+    sunset['sunset_second_order_date'] = sunset['sunset_customer_id'].map(second_orders['created_at'])
+    sunset['sunset_second_order_subscription'] = sunset['sunset_customer_id'].map(second_orders['is_subscription'])
+    order_item_counts = orders.set_index('id')['item_count']
+    sunset['sunset_first_order_item_count'] = sunset['sunset_first_order_id'].map(order_item_counts)
+    sunset['sunset_second_order_item_count'] = sunset['sunset_second_order_id'].map(order_item_counts)
+
+    customers = customers.join(sunset, how='outer').rename_axis('email').reset_index()
+    return {'orders': orders, 'customers': customers}
 
 def process_retention_table(dfs):
     """Process data for retention_table"""
-    orders_df = dfs['orders'].copy()
+    cohorts = dfs['cohorts'] if 'cohorts' in dfs else build_cohort_index(dfs)
+    orders_df = cohorts['orders']
     items_df = dfs['order_items'].copy()
     
     # Convert id columns to int and create indices
-    orders_df['id'] = orders_df['id'].astype(int)
-    orders_df['customer_id'] = orders_df['customer_id'].astype(int)
     items_df['order_id'] = items_df['order_id'].astype(int)
     items_df['id'] = items_df['id'].astype(int)
     
     print(f"After initial orders query: {len(orders_df)}")
     
-    # Filter for valid orders
-    valid_orders = orders_df[orders_df['state'].isin(['fulfilled', 'new'])]
-
-    # Get orders that actually have items - filter out order_id with no items (from sylius_order_item)
-    orders_with_items = valid_orders[valid_orders['id'].isin(items_df['order_id'].unique())]
-    
-    # Get the first order (with items) for each email (customer)
-    first_orders = orders_with_items.groupby('email').agg({
-        'id': 'min',
-        'created_at': 'min',
-        'customer_id': 'first'
-    }).reset_index()
-    first_orders.columns = ['email', 'first_order_id', 'first_order_date', 'customer_id']
-    first_orders['first_order_id'] = first_orders['first_order_id'].astype(int)
-    first_orders['customer_id'] = first_orders['customer_id'].astype(int)
+    # The first order (with items) of each email (customer), with its fulfilled or new order count
+    customers = cohorts['customers']
+    first_orders = customers[customers['first_order_id'].notna()]
+    first_orders = first_orders[[
+        'email', 'first_order_id', 'first_order_date', 'customer_id', 'order_count', 'second_order_id',
+        'first_order_item_count'
+    ]].rename(columns={'first_order_item_count': 'first_order_total_item_count'})
+    first_orders = first_orders.reset_index(drop=True).astype(
+        {'first_order_id': int, 'customer_id': int, 'order_count': int, 'first_order_total_item_count': int}
+    )
     
     print(f"\nAfter first_orders: {len(first_orders)}")
     
-    # Get total order counts per email
-    order_counts = valid_orders.groupby('email').size().reset_index(name='order_count')
-    
-    # Mark each row in items_df with a row number per order_id
-    items_df['rn'] = items_df.groupby('order_id')['id'].rank(method='first')
-    items_df['total_items_count'] = items_df.groupby('order_id')['id'].transform('count')
-    
-    # First and second item per order
+    # First and second item per order, items_df rows carry their rank (rn)
     first_items = items_df[items_df['rn'] == 1].copy()
     second_items = items_df[items_df['rn'] == 2].copy()
     second_items = second_items.rename(columns={'product_name': 'first_order_second_product_name'})[['order_id', 'first_order_second_product_name']]
@@ -162,7 +264,6 @@ def process_retention_table(dfs):
     # Build the retention_df starting with first_orders
     retention_df = (
         first_orders
-        .merge(order_counts, on='email')
         .merge(
             orders_df[['id', 'is_subscription']], 
             left_on='first_order_id', 
@@ -176,15 +277,14 @@ def process_retention_table(dfs):
     
     # Merge in details for the first item
     retention_df = retention_df.merge(
-        first_items[['order_id', 'product_name', 'variant_name', 'quantity', 'total_items_count']],
+        first_items[['order_id', 'product_name', 'variant_name', 'quantity']],
         left_on='first_order_id',
         right_on='order_id',
         how='left'
     ).rename(columns={
         'product_name': 'first_product_name',
         'variant_name': 'first_product_variant',
-        'quantity': 'first_product_quantity',
-        'total_items_count': 'first_order_total_item_count'
+        'quantity': 'first_product_quantity'
     })
 
     print(f"\nAfter items merge: {len(retention_df)}")
@@ -215,7 +315,6 @@ def process_retention_table(dfs):
     # Calculate upsell flags
     retention_df['bought_upsell_more_of_the_same'] = optimize_check_same_product(
         retention_df[retention_df['first_order_total_item_count'] > 1],
-        items_df,
         first_items
     )
     retention_df['bought_upsell_more_of_the_same'] = retention_df['bought_upsell_more_of_the_same'].fillna(False)
@@ -231,21 +330,7 @@ def process_retention_table(dfs):
     
     retention_df['first_order_second_product_name'] = retention_df['first_order_second_product_name'].fillna('')
     
-    # Get second orders for each email
-    second_orders = get_second_orders_bulk(orders_df, retention_df['email'])
-    # 'second_orders' is a DF with the second order as a row, but 'id' is the second order's ID
-    # Keep only the columns we need (email + 'id') and rename
-    second_orders = second_orders[['email', 'id']].rename(columns={'id': 'second_order_id'})
-    # If email is in the index, reset it
-    second_orders = second_orders.reset_index(drop=True)
-    
-    # Merge second_order_id into retention_df
-    retention_df = retention_df.merge(
-        second_orders,
-        on='email',
-        how='left'
-    )
-    
+    # The second order of each email (second_order_id) comes from the cohort index
     # Get the "first item" of that second order using items_df
     second_order_items = items_df[items_df['rn'] == 1][['order_id', 'product_name']]
     second_order_items = second_order_items.rename(columns={'product_name': 'first_item_from_second_order'})
@@ -308,47 +393,40 @@ def process_retention_table(dfs):
 
 
 
+def first_item_values(items_df):
+    """Get the first non-empty product_name, variant_name and quantity of every order, by item rank (rn)
+
+    Indexed by order_id, with the first_product_repeated flag of the order
+    """
+    # Ranked rows come in rank order, the first row of an order with a value is its first value
+    items = items_df.sort_values('rn', kind='stable')
+    first_values = items.drop_duplicates('order_id').set_index('order_id')[['first_product_repeated']]
+    for column in ['product_name', 'variant_name', 'quantity']:
+        first_values[column] = items[items[column].notna()].drop_duplicates('order_id').set_index('order_id')[column]
+    return first_values
+
 def process_sunset_table(dfs):
     """Process data for sunset_table"""
-    orders_df = dfs['orders']
+    cohorts = dfs['cohorts'] if 'cohorts' in dfs else build_cohort_index(dfs)
     items_df = dfs['order_items']
     
-    # Filter non-subscription orders and no created_from_order_id
-    non_sub_orders = orders_df[
-        (~orders_df['is_subscription']) & 
-        (orders_df['created_from_order_id'].isna()) &
-        (orders_df['state'].isin(['fulfilled', 'new']))
+    # Customers with a first and a second non-subscription order (not created from another order), both with items
+    customers = cohorts['customers']
+    sunset_df = customers[
+        (customers['sunset_first_order_item_count'] > 0) & (customers['sunset_second_order_item_count'] > 0)
+    ][[
+        'email', 'sunset_first_order_id', 'sunset_first_order_date', 'sunset_customer_id', 'sunset_order_count',
+        'sunset_second_order_id', 'sunset_second_order_date', 'sunset_second_order_subscription',
+        'sunset_first_order_item_count'
+    ]].reset_index(drop=True)
+    sunset_df.columns = [
+        'email', 'first_order_id', 'first_order_date', 'customer_id', 'order_count', 'id', 'created_at', 'is_subscription',
+        'first_order_total_item_count'
     ]
-    
-    # Get first orders
-    first_orders = non_sub_orders.groupby('email').agg({
-        'id': 'min',
-        'created_at': 'min',
-        'customer_id': 'first'
-    }).reset_index()
-    first_orders.columns = ['email', 'first_order_id', 'first_order_date', 'customer_id']
-    
-    # Count total orders per customer
-    order_counts = orders_df.groupby('email').size().reset_index(name='order_count')
-    
-    # Get second orders
-    def get_second_order(group):
-        ordered_group = group.sort_values('id')
-        if len(ordered_group) < 2:
-            return None
-        return ordered_group.iloc[1]
-    
-    second_orders = non_sub_orders.groupby('customer_id').apply(
-        get_second_order
-    ).reset_index(drop=True)
-    
-    # Merge first and second orders
-    sunset_df = first_orders.merge(order_counts)
-    sunset_df = sunset_df.merge(
-        second_orders[['customer_id', 'id', 'created_at', 'is_subscription']], 
-        on='customer_id', 
-        suffixes=('', '_second')
-    )
+    sunset_df = sunset_df.astype({
+        'first_order_id': int, 'customer_id': int, 'order_count': int, 'id': int, 'is_subscription': bool,
+        'first_order_total_item_count': int
+    })
     
     # Calculate days between orders
     sunset_df['days_between_first_and_second_order'] = (
@@ -356,55 +434,17 @@ def process_sunset_table(dfs):
         pd.to_datetime(sunset_df['first_order_date'])
     ).dt.days
     
-    # Get order items for both orders
-    first_items = items_df.merge(
-        sunset_df[['first_order_id']], 
-        left_on='order_id', 
-        right_on='first_order_id'
-    )
-    second_items = items_df.merge(
-        sunset_df[['id']], 
-        left_on='order_id', 
-        right_on='id'
-    )
-    
-    # Get first items from both orders
-    first_order_first_item = first_items.groupby('order_id').first().reset_index()
-    second_order_first_item = second_items.groupby('order_id').first().reset_index()
-    second_order_first_item = second_order_first_item.rename(
-        columns={'product_name': 'second_order_first_product_name'}
-    )
-    
-    # Calculate total items in first order
-    first_order_totals = first_items.groupby('order_id').size().reset_index(name='first_order_total_item_count')
-    
-    # Calculate more_of_the_same flag
-    def has_same_product(order_id, product_name):
-        order_items = first_items[first_items['order_id'] == order_id]
-        return (order_items['product_name'] == product_name).sum() > 1
-    
-    # Merge all information
-    sunset_df = sunset_df.merge(
-        first_order_first_item[['order_id', 'product_name', 'variant_name', 'quantity']], 
-        left_on='first_order_id', 
-        right_on='order_id'
-    )
-    sunset_df = sunset_df.merge(
-        second_order_first_item[['order_id', 'second_order_first_product_name']], 
-        left_on='id', 
-        right_on='order_id',
-        suffixes=('', '_second')
-    )
-    sunset_df = sunset_df.merge(
-        first_order_totals, 
-        left_on='first_order_id', 
-        right_on='order_id'
+    # First item values of both orders
+    first_values = first_item_values(items_df)
+    sunset_df = sunset_df.join(
+        first_values[['product_name', 'variant_name', 'quantity', 'first_product_repeated']], on='first_order_id'
     )
+    sunset_df['second_order_first_product_name'] = sunset_df['id'].map(first_values['product_name'])
     
     # Calculate bought_upsell_more_of_the_same
-    sunset_df['bought_upsell_more_of_the_same'] = sunset_df.apply(
-        lambda x: has_same_product(x['first_order_id'], x['product_name']) if x['first_order_total_item_count'] > 1 else False,
-        axis=1
+    # More than one item row of the first order has its first product name, flagged by rank_order_items
+    sunset_df['bought_upsell_more_of_the_same'] = (
+        (sunset_df['first_order_total_item_count'] > 1) & sunset_df['first_product_repeated']
     )
     
     # Rename columns to match schema
@@ -425,94 +465,117 @@ def process_sunset_table(dfs):
                      'second_order_first_product_name', 'bought_upsell_more_of_the_same']]
 
 
-def load_table(df, table_name, connection, chunk_size=7000):
-    """Load function to insert data into MySQL table"""
+def load_table(df, table_name, connection_config, chunk_size=7000, use_shadow_table=True, parallelism=LOAD_PARALLELISM):
+    """Load function to insert data into MySQL table, through a shadow copy swapped in at the end unless use_shadow_table is False"""
     if df.empty:
         print("No new rows to insert.")
         return
 
     try:
-        cursor = connection.cursor()
-        connection.autocommit = False
-
-        # Truncate table before inserting new data
-        print(f"Truncating table '{table_name}'...")
-        cursor.execute(f"TRUNCATE TABLE {table_name}")
-
-        columns = df.columns
-        columns_list_str = ', '.join(f"`{col}`" for col in columns)
-        placeholders = ', '.join(['%s'] * len(columns))
-        insert_query = f"INSERT INTO {table_name} ({columns_list_str}) VALUES ({placeholders})"
-
-        total_inserted = 0
-        total_chunks = (len(df) + chunk_size - 1) // chunk_size
-        
-        # Insert data in chunks with executemany
-        for chunk_num, start in enumerate(range(0, len(df), chunk_size), 1):
-            end = start + chunk_size
-            chunk = df.iloc[start:end]
-            values = [tuple(row) for row in chunk.values]
-            
-            cursor.executemany(insert_query, values)
-            connection.commit()
-            
-            total_inserted += len(chunk)
-            print(f"Processed chunk {chunk_num}/{total_chunks} - Inserted {total_inserted}/{len(df)} rows...")
-
-        connection.autocommit = True
-        print(f"Successfully inserted all {total_inserted} rows.")
-        cursor.close()
-
+        total_inserted = replace_table_rows(connection_config, table_name, df, chunk_size, use_shadow_table, parallelism)
+        print(f"Successfully inserted all {total_inserted} rows into '{table_name}'.")
     except mysql.connector.Error as error:
         print(f"Error while loading data to MySQL: {error}")
-        connection.rollback()
         raise
 
-def etl_process(brand):
-    """ETL process for the given brand"""
-    try:
-        print(f"Starting ETL process for {brand}")
-        db_details = get_target_db_details(brand)
-
-        global source_crm_db_name, target_db_user, target_db_password, target_db_host, target_db_port
-        source_crm_db_name = db_details['database']
-        target_db_user = db_details['user']
-        target_db_password = db_details['password']
-        target_db_host = db_details['host']
-        target_db_port = db_details['port']
-
-        connection = mysql.connector.connect(
-            database=source_crm_db_name,
-            user=target_db_user,
-            password=target_db_password,
-            host=target_db_host,
-            port=target_db_port
-        )
+def load_brand(context, retention_df, sunset_df):
+    """Load the retention and sunset tables of the context's brand, returns the number of rows of each table"""
+    context.frames['retention_df'] = retention_df
+    context.frames['sunset_df'] = sunset_df
+
+    print(f"Loading data for {context.brand}...")
+    # Connections per table, the retention and sunset tables are loaded at the same time
+    parallelism = int(get_variable("etl_load_parallelism", default_var=LOAD_PARALLELISM))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        loads = [
+            executor.submit(load_table, retention_df, 'retention_table', context.target_config, parallelism=parallelism),
+            executor.submit(load_table, sunset_df, 'sunset_table', context.target_config, parallelism=parallelism)
+        ]
+        for load in loads:
+            load.result()
+
+    print(f"ETL process completed for {context.brand}")
+    return {'retention_table': len(retention_df), 'sunset_table': len(sunset_df)}
+
+def run_etl(context, pushdown=False):
+    """ETL process for the context's brand, returns the number of rows of each table"""
+    print(f"Starting ETL process for {context.brand}")
+
+    print("Extracting data...")
+    dfs = extract(context, pushdown)
+
+    # First and second orders of every customer, shared by both tables
+    dfs['cohorts'] = build_cohort_index(dfs)
+
+    # Process retention_table
+    print("Processing retention table...")
+    retention_df = process_retention_table(dfs)
+
+    # Process sunset_table
+    print("Processing sunset table...")
+    sunset_df = process_sunset_table(dfs)
+
+    return load_brand(context, retention_df, sunset_df)
+
+def run_etl_batched(brands=BRANDS, pushdown=False):
+    """ETL process for several brands with a single pass of process_retention_table and process_sunset_table
+
+    The ids and emails of the stacked data carry their brand index, so the customers and orders of different
+    brands are never mixed. Returns the number of rows of each table, per brand
+    """
+    contexts = [create_brand_context(brand) for brand in brands]
+
+    # One extract thread per brand
+    print(f"Extracting data of {len(brands)} brand(s)...")
+    with ThreadPoolExecutor(max_workers=len(contexts)) as executor:
+        extracted = list(executor.map(extract, contexts, [pushdown] * len(contexts)))
+
+    dfs = {
+        'orders': stack_brand_frames([brand_dfs['orders'] for brand_dfs in extracted], ['id', 'customer_id'], ['email']),
+        'order_items': stack_brand_frames([brand_dfs['order_items'] for brand_dfs in extracted], ['order_id', 'id'])
+    }
+    dfs['cohorts'] = build_cohort_index(dfs)
 
-        print("Extracting data...")
-        dfs = extract()
+    print(f"Processing retention table of {len(brands)} brand(s) at once...")
+    retention_dfs = split_brand_frame(
+        process_retention_table(dfs), 'customer_id', len(contexts), ['customer_id', 'first_order_id'], ['email']
+    )
 
-        # Process retention_table
-        print("Processing retention table...")
-        retention_df = process_retention_table(dfs)
+    print(f"Processing sunset table of {len(brands)} brand(s) at once...")
+    sunset_dfs = split_brand_frame(
+        process_sunset_table(dfs), 'customer_id', len(contexts), ['customer_id', 'first_order_id', 'second_order_id'], ['email']
+    )
 
-        # Process sunset_table
-        print("Processing sunset table...")
-        sunset_df = process_sunset_table(dfs)
+    return {
+        context.brand: load_brand(context, retention_df, sunset_df)
+        for context, retention_df, sunset_df in zip(contexts, retention_dfs, sunset_dfs)
+    }
 
-        print("Loading data...")
-        load_table(retention_df, 'retention_table', connection)
-        load_table(sunset_df, 'sunset_table', connection)
-        
-        connection.close()
-        print(f"ETL process completed for {brand}")
-        
+def etl_process(brand):
+    """ETL process for the given brand"""
+    try:
+        return run_etl(create_brand_context(brand), use_pushdown_mode())
     except Exception as e:
         print(f"An error occurred during the ETL process for {brand}: {str(e)}")
-        if 'connection' in locals():
-            connection.close()
         raise
 
+def run_brand(brand):
+    """Run the ETL process of one brand, for run_all_brands"""
+    return run_etl(create_brand_context(brand), use_pushdown_mode())
+
+def run_batch(brands):
+    """Run the ETL process of several brands with a single transform, for run_all_brands"""
+    return run_etl_batched(brands, use_pushdown_mode())
+
+def run_all_brands(brands=BRANDS, max_workers=None, use_processes=True):
+    """Run the ETL process of several brands at once, and return a BrandResult per brand
+
+    In batched mode the brands share one transform, max_workers and use_processes don't apply
+    """
+    if use_batched_mode():
+        return run_batched(run_batch, brands)
+    return run_brands(run_brand, brands, max_workers, use_processes)
+
 def run_etl_process_by_brand(brand):
     """Run ETL process"""
     if brand not in BRANDS:
@@ -536,5 +599,7 @@ def run_etl_process_mno():
     etl_process('MNO')
 
 if __name__ == "__main__":
-    for brand in BRANDS:
-        run_etl_process_by_brand(brand)
+    # Optional argument: number of brands processed at once (all of them by default)
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    results = run_all_brands(max_workers=max_workers)
+    sys.exit(1 if any(result.error is not None for result in results.values()) else 0)
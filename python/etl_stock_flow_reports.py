@@ -2,22 +2,33 @@
 Script to process Stock Flow reports
 """
 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import datetime
+import os
+import sys
+
 import mysql.connector
+import numpy as np
 import pandas as pd
 
-# Load environment variables from Airflow
-from airflow.models import Variable
+from brand_runner import BrandContext, run_batched, run_brands, split_brand_frame, stack_brand_frames
+from db_utils import (
+    LOAD_PARALLELISM, bulk_insert, create_shadow_table, delete_by_ids, get_connection, get_variable, read_query,
+    replace_table_rows, swap_shadow_table
+)
 
 # List of all brands
 BRANDS = ['ABC', 'DEF', 'GHI', 'JKL', 'MNO']
 
 # def get_source_db_details(brand):
 #     return {
-#         'database': Variable.get(f'source_crm_db_name_{brand.lower()}'),
-#         'user': Variable.get('source_crm_db_user'),
-#         'password': Variable.get('source_crm_db_password'),
-#         'host': Variable.get('source_crm_db_host'),
-#         'port': Variable.get('source_crm_db_port')
+#         'database': get_variable(f'source_crm_db_name_{brand.lower()}'),
+#         'user': get_variable('source_crm_db_user'),
+#         'password': get_variable('source_crm_db_password'),
+#         'host': get_variable('source_crm_db_host'),
+#         'port': get_variable('source_crm_db_port')
 #     }
 
 # Here we use the variables for target DB. We will transfer the tables from source DB to target DB 
@@ -25,23 +36,47 @@ BRANDS = ['ABC', 'DEF', 'GHI', 'JKL', 'MNO']
 def get_source_db_details(brand):
     """Get source database details for the given brand"""
     return {
-        'database': Variable.get(f'target_db_name_{brand.lower()}'),
-        'user': Variable.get('target_db_user'),
-        'password': Variable.get('target_db_password'),
-        'host': Variable.get('target_db_host'),
-        'port': Variable.get('target_db_port')
+        'database': get_variable(f'target_db_name_{brand.lower()}'),
+        'user': get_variable('target_db_user'),
+        'password': get_variable('target_db_password'),
+        'host': get_variable('target_db_host'),
+        'port': get_variable('target_db_port')
     }
 
 def get_target_db_details():
     """Get target database details for the given brand"""
     return {
-        'database': Variable.get('target_db_name_stock_reports'),
-        'user': Variable.get('target_db_user'),
-        'password': Variable.get('target_db_password'),
-        'host': Variable.get('target_db_host'),
-        'port': Variable.get('target_db_port')
+        'database': get_variable('target_db_name_stock_reports'),
+        'user': get_variable('target_db_user'),
+        'password': get_variable('target_db_password'),
+        'host': get_variable('target_db_host'),
+        'port': get_variable('target_db_port')
     }
 
+def create_brand_context(brand):
+    """Build the context of a brand run, with its source and target connection settings"""
+    return BrandContext(brand, get_source_db_details(brand), get_target_db_details())
+
+# Table in the target DB keeping the incremental watermark of each brand
+WATERMARK_TABLE = 'etl_stock_flow_watermark'
+
+# The report tables are fully rebuilt at least this often, which also picks up changes that
+# don't update sylius_order.updated_at (e.g., new promotion SKUs for existing products)
+FULL_REFRESH_INTERVAL = datetime.timedelta(hours=24)
+
+# Default memory budget of a partitioned run, shared by all its workers (Variable etl_partition_memory_budget_mb)
+PARTITION_MEMORY_BUDGET_MB = 2048
+
+# Estimated peak memory of one extracted row going through the transform chain, with the copies made on the way
+BYTES_PER_EXTRACTED_ROW = 4096
+
+# Smallest order_id range worth a task. With a small budget the number of workers goes down instead
+MIN_PARTITION_ROWS = 10000
+
+# Columns loaded to the target tables
+NON_BUNDLE_COLUMNS = ['order_id', 'created_at', 'quantity', 'warehouse_sku']
+ONLY_BUNDLE_COLUMNS = ['order_id', 'created_at', 'bundle_product_id', 'bundle_product_name', 'bundle_variant_id', 'bundle_variant_name', 'bundle_quantity', 'bundle_sku']
+
 def get_target_table_names(brand):
     """Function to get target table names for each brand"""
     brand_lower = brand.lower()
@@ -50,23 +85,68 @@ def get_target_table_names(brand):
         'only_bundle': f'report_{brand_lower}_only_bundle'
     }
 
-def extract():
-    """Extract required data"""
-    try:
-        connection = mysql.connector.connect(
-            database=source_crm_db_name,
-            user=source_crm_db_user,
-            password=source_crm_db_password,
-            host=source_crm_db_host,
-            port=source_crm_db_port
-        )
-        print("Connected to MySQL (Source DB) successfully.")
+def get_watermark(context):
+    """Get the incremental watermark of the context's brand, None if the brand has never been loaded"""
+    connection = get_connection(context.target_config)
+    cursor = connection.cursor(dictionary=True)
 
-        cursor = connection.cursor(dictionary=True)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        brand VARCHAR(16) NOT NULL PRIMARY KEY,
+        updated_at DATETIME NOT NULL,
+        last_full_refresh_at DATETIME NOT NULL
+    )
+    """)
+    cursor.execute(f"SELECT updated_at, last_full_refresh_at FROM {WATERMARK_TABLE} WHERE brand = %s", (context.brand,))
+    watermark = cursor.fetchone()
 
-        # SQL query
-        query = f"""
-        SELECT DISTINCT
+    cursor.close()
+    connection.close()
+    return watermark
+
+
+def save_watermark(context, updated_at, full_refresh_at=None):
+    """Save the incremental watermark of the context's brand, and the time of the full refresh if it was one"""
+    connection = get_connection(context.target_config)
+    cursor = connection.cursor()
+
+    if full_refresh_at is not None:
+        cursor.execute(f"""
+        INSERT INTO {WATERMARK_TABLE} (brand, updated_at, last_full_refresh_at) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE updated_at = VALUES(updated_at), last_full_refresh_at = VALUES(last_full_refresh_at)
+        """, (context.brand, updated_at, full_refresh_at))
+    else:
+        cursor.execute(f"UPDATE {WATERMARK_TABLE} SET updated_at = %s WHERE brand = %s", (updated_at, context.brand))
+    connection.commit()
+
+    print(f"Saved watermark {updated_at} for {context.brand}.")
+    cursor.close()
+    connection.close()
+
+
+def extract_order_updates(context, changed_since=None):
+    """Extract id and updated_at of the orders updated since changed_since (all states), or only the latest updated_at"""
+    connection = get_connection(context.source_config)
+
+    if changed_since is None:
+        df = read_query(connection, "SELECT MAX(updated_at) AS updated_at FROM sylius_order")
+    else:
+        df = read_query(connection, "SELECT id, updated_at FROM sylius_order WHERE updated_at >= %s", (changed_since,))
+
+    connection.close()
+    return df
+
+
+def latest_order_update(context):
+    """Get the latest updated_at of the orders, None if no order has one (e.g. an empty sylius_order)"""
+    updated_at = extract_order_updates(context)['updated_at']
+    if updated_at.empty or pd.isna(updated_at.iloc[0]):
+        return None
+    return pd.Timestamp(updated_at.iloc[0]).to_pydatetime()
+
+
+# Columns of the extract. With EXTRACT_JOINS, they are checked against the transfer manifest by transfer_manifest.py
+EXTRACT_COLUMNS = """
             soi.order_id,
             so.created_at,
             so.updated_at,
@@ -82,6 +162,10 @@ def extract():
             scpi.promotion_warehouse_sku AS scpi_promotion_warehouse_sku,
             scpi.count,
             sp.mint_soft_sku
+"""
+
+# Joins and filters of the extract, shared with the query sizing the order_id ranges of the partitioned mode
+EXTRACT_JOINS = """
         FROM
             sylius_order_item soi
         LEFT JOIN
@@ -97,24 +181,150 @@ def extract():
         WHERE
             so.payment_state IN('paid', 'partially_paid', 'partially_refunded', 'refunded')
             AND mint_soft_sku IS NOT NULL
+"""
+
+
+def extract(context, changed_since=None, order_range=None):
+    """Extract required data, only for the orders updated since changed_since if given
+
+    order_range limits the extract to the order_ids in [first, end), None meaning no bound on that side
+    """
+    try:
+        connection = get_connection(context.source_config)
+        print("Connected to MySQL (Source DB) successfully.")
+
+        # In incremental mode only the orders updated since the watermark are extracted
+        filters = []
+        params = []
+        if changed_since is not None:
+            filters.append("AND so.updated_at >= %s")
+            params.append(changed_since)
+        if order_range is not None:
+            if order_range[0] is not None:
+                filters.append("AND soi.order_id >= %s")
+                params.append(order_range[0])
+            if order_range[1] is not None:
+                filters.append("AND soi.order_id < %s")
+                params.append(order_range[1])
+        changed_filter = "\n            ".join(filters)
+        params = tuple(params) if params else None
+
+        # SQL query
+        query = f"""
+        SELECT DISTINCT
+            {EXTRACT_COLUMNS}
+        {EXTRACT_JOINS}
+            {changed_filter}
         ORDER BY soi.order_id
         """
 
-        cursor.execute(query)
-        results = cursor.fetchall()
-
-        df = pd.DataFrame(results)
+        # Stream the result in batches into typed columns
+        df = read_query(connection, query, params)
 
-        cursor.close()
         connection.close()
 
         return df
 
     except mysql.connector.Error as error:
         print(f"Error while connecting to MySQL: {error}")
+        if 'connection' in locals():
+            connection.close()
+        if changed_since is not None or order_range is not None:
+            # An empty result would delete the report rows of the changed orders, or leave out a whole range
+            raise
         return pd.DataFrame()  # Return an empty DataFrame in case of error
 
 
+# Parsed form of a promotion SKU such as 'ABC#4|DEF#0'
+ParsedSku = namedtuple('ParsedSku', ['base_sku', 'sku_quantity', 'is_bundle', 'part_skus', 'part_quantities', 'clean_bundle_sku'])
+
+
+def get_sku_quantity(sku_parts):
+    """Get the quantity after '#' of a SKU split by '#', None if there is none or if it's not a number"""
+    if len(sku_parts) > 1:
+        try:
+            return int(sku_parts[1])
+        except ValueError:
+            return None
+    return None
+
+
+@lru_cache(maxsize=None)
+def parse_promotion_sku(sku):
+    """Parse a distinct promotion SKU once, the result is cached for all rows, stages and brands"""
+    sku_parts = sku.split('#')
+    bundle_parts = [part.split('#') for part in sku.split('|')]
+    return ParsedSku(
+        base_sku=sku_parts[0],
+        sku_quantity=get_sku_quantity(sku_parts),
+        is_bundle='|' in sku,
+        part_skus=tuple(part[0] for part in bundle_parts),
+        part_quantities=tuple(get_sku_quantity(part) for part in bundle_parts),
+        clean_bundle_sku='|'.join(part[0] for part in bundle_parts)
+    )
+
+
+def encode_skus(skus):
+    """Dictionary-encode SKUs into an integer code per row (-1 if missing) and a table of the parsed distinct SKUs"""
+    codes, uniques = pd.factorize(skus)
+    parsed_skus = pd.DataFrame([parse_promotion_sku(str(sku)) for sku in uniques], columns=ParsedSku._fields)
+    return codes, parsed_skus
+
+
+def lookup_parsed_skus(parsed_skus, column, codes, missing=None):
+    """Look up a column of the parsed SKUs table for each code, code -1 gets the missing value"""
+    return np.append(parsed_skus[column].to_numpy(dtype=object), [missing])[codes]
+
+
+def split_sku_quantities(skus):
+    """Split SKUs such as 'ABC#4' into base SKU and quantity (NaN if absent or not a number)"""
+    codes, parsed_skus = encode_skus(skus)
+    return (
+        pd.Series(lookup_parsed_skus(parsed_skus, 'base_sku', codes), index=skus.index, dtype=object),
+        pd.Series(lookup_parsed_skus(parsed_skus, 'sku_quantity', codes), index=skus.index, dtype='float64')
+    )
+
+
+def sku_is_bundle(skus):
+    """Check which SKUs are bundles, i.e. have a pipe character "|" """
+    codes, parsed_skus = encode_skus(skus)
+    return pd.Series(lookup_parsed_skus(parsed_skus, 'is_bundle', codes, False), index=skus.index, dtype=bool)
+
+
+def resolve_pricing_tiers(order_item_df, pricing_item_df):
+    """Find for each order item the largest pricing tier (count <= quantity) with a scpi SKU within the same order"""
+    # Only tiers with a count and a scpi SKU can be picked. For equal counts the first tier of the order wins
+    tiers = pricing_item_df[pricing_item_df['count'].notna() & pricing_item_df['scpi_promotion_warehouse_sku'].notna()]
+    tiers = tiers.drop_duplicates(subset=['order_id', 'count'], keep='first')
+    tiers = pd.DataFrame({
+        'order_id': tiers['order_id'].values,
+        'tier_key': tiers['count'].astype('float64').values,
+        'tier_sku': tiers['scpi_promotion_warehouse_sku'].values,
+        'tier_count': tiers['count'].values
+    }).sort_values('tier_key', kind='stable')
+
+    items = pd.DataFrame({
+        'order_id': order_item_df['order_id'].values,
+        'tier_key': order_item_df['quantity'].astype('float64').values,
+        'row_pos': range(len(order_item_df))
+    })
+    items = items[items['tier_key'].notna()].sort_values('tier_key', kind='stable')
+
+    # Sorted lookup per order: the last tier whose count is <= quantity
+    matched = pd.merge_asof(items, tiers, on='tier_key', by='order_id', direction='backward')
+    matched = matched.set_index('row_pos').reindex(range(len(order_item_df)))
+
+    # Items without a tier come back as NaN, their count is 0 and keeps the dtype of the pricing item counts
+    tier_count = matched['tier_count'].fillna(0)
+    if pd.api.types.is_integer_dtype(pricing_item_df['count']):
+        tier_count = tier_count.astype(pricing_item_df['count'].dtype)
+
+    return (
+        pd.Series(matched['tier_sku'].values, index=order_item_df.index, dtype=object),
+        pd.Series(tier_count.values, index=order_item_df.index)
+    )
+
+
 def transform(df):
     """Main transform function to process the extracted data"""
     # Create separate DataFrames for each table
@@ -128,49 +338,35 @@ def transform(df):
         # Add original_quantity column
         reporting_df['original_quantity'] = reporting_df['quantity']
 
-        # Group pricing items by order_id
-        pricing_groups = pricing_item_df.groupby('order_id')
-        
-        def get_sku_and_count(row, pricing_group):
-            if pricing_group.empty or (pd.isna(row['scp_promotion_warehouse_sku']) and pricing_group['scpi_promotion_warehouse_sku'].isna().all()):
-                return pd.Series({'final_sku': row['mint_soft_sku'], 'applied_count': 0, 'quantity': row['quantity'], 'count': 0})
-            
-            # Sort pricing items by count in descending order
-            sorted_pricing = pricing_group.sort_values('count', ascending=False)
-            
-            for _, price_item in sorted_pricing.iterrows():
-                if row['quantity'] >= price_item['count'] and not pd.isna(price_item['scpi_promotion_warehouse_sku']):
-                    final_sku = price_item['scpi_promotion_warehouse_sku']
-                    applied_count = price_item['count']
-                    break
-            else:
-                final_sku = row['scp_promotion_warehouse_sku'] if not pd.isna(row['scp_promotion_warehouse_sku']) else row['mint_soft_sku']
-                applied_count = 0
-            
-            # Handle the sku and quantity logic
-            sku_parts = final_sku.split('#')
-            final_sku = sku_parts[0]
-            
-            if len(sku_parts) > 1:
-                try:
-                    sku_quantity = int(sku_parts[1])
-                    if sku_quantity != 0 and not pd.isna(row['scpi_promotion_warehouse_sku']) and row['scpi_promotion_warehouse_sku'] != '':
-                        quantity = sku_quantity
-                    else:
-                        quantity = row['quantity']
-                except ValueError:
-                    quantity = row['quantity']
-            else:
-                quantity = row['quantity']
-            
-            return pd.Series({'final_sku': final_sku, 'applied_count': applied_count, 'quantity': quantity, 'count': applied_count})
-        
-        # Apply the get_sku_and_count function to each row, passing the corresponding pricing group
-        reporting_df[['final_sku', 'applied_count', 'quantity', 'count']] = reporting_df.apply(
-            lambda row: get_sku_and_count(row, pricing_groups.get_group(row['order_id']) if row['order_id'] in pricing_groups.groups else pd.DataFrame()),
-            axis=1
+        # Resolve the pricing tier of every row at once
+        tier_sku, tier_count = resolve_pricing_tiers(reporting_df, pricing_item_df)
+
+        scp_sku = reporting_df['scp_promotion_warehouse_sku']
+        scpi_sku = reporting_df['scpi_promotion_warehouse_sku']
+        quantity = reporting_df['quantity']
+
+        # Orders without any pricing item, or rows without scp SKU in orders without any scpi SKU, keep the mint_soft_sku as it is
+        orders_in_pricing = pricing_item_df['order_id'].unique()
+        orders_with_scpi = pricing_item_df.loc[pricing_item_df['scpi_promotion_warehouse_sku'].notna(), 'order_id'].unique()
+        use_mint_sku = ~reporting_df['order_id'].isin(orders_in_pricing) | (scp_sku.isna() & ~reporting_df['order_id'].isin(orders_with_scpi))
+
+        # Otherwise pick the tier SKU, then fall back to the scp SKU, then to the mint_soft_sku
+        has_tier = tier_sku.notna() & ~use_mint_sku
+        final_sku = tier_sku.where(has_tier, scp_sku.where(scp_sku.notna(), reporting_df['mint_soft_sku']))
+        applied_count = tier_count.where(has_tier, 0)
+
+        # Handle the sku and quantity logic - each distinct SKU string is only split once
+        base_sku, sku_quantity = split_sku_quantities(final_sku.where(~use_mint_sku))
+        use_sku_quantity = (
+            ~use_mint_sku & sku_quantity.notna() & (sku_quantity != 0) &
+            scpi_sku.notna() & (scpi_sku != '')
         )
-        
+
+        reporting_df['final_sku'] = base_sku.where(~use_mint_sku, reporting_df['mint_soft_sku'])
+        reporting_df['applied_count'] = applied_count.where(~use_mint_sku, 0)
+        reporting_df['quantity'] = sku_quantity.where(use_sku_quantity, quantity).astype(quantity.dtype)
+        reporting_df['count'] = reporting_df['applied_count']
+
         reporting_df['row_num'] = range(len(reporting_df))
         return reporting_df
 
@@ -180,80 +376,88 @@ def transform(df):
 
     # Function to drop duplicates based on scpi_promotion_warehouse_sku presence
     def drop_duplicates_based_on_sku(df):
-        df_sorted = df.sort_values(by='scpi_promotion_warehouse_sku', ascending=False)  # Ensure rows with scpi_sku come first
+        # Ensure rows with scpi_sku come first. The sorts are stable, so rows with equal keys keep their extract order
+        df_sorted = df.sort_values(by='scpi_promotion_warehouse_sku', ascending=False, kind='stable')
         return df_sorted.drop_duplicates(subset=['order_id', 'unit_price', 'units_total', 'product_id', 'variant_id', 'product_name', 'variant_name', 'final_sku'], keep='first')
 
     reporting_df = drop_duplicates_based_on_sku(reporting_df)
-    reporting_df = reporting_df.sort_values(by='order_id', ascending=True)
+    reporting_df = reporting_df.sort_values(by='order_id', ascending=True, kind='stable')
     reporting_df['row_num'] = range(len(reporting_df))
     return reporting_df
 
 
 def duplicate_rows_with_pipe(df):
     """Function to specifically handle the rows with pipe |"""
-    def split_row(row, prev_row):
-        new_rows = []
-        bundle_sku = None
-
-        for col in ['scpi_promotion_warehouse_sku', 'scp_promotion_warehouse_sku']:
-            if pd.notna(row[col]) and '|' in str(row[col]):
-                skus = str(row[col]).split('|')
-                # we store the original bundle SKU in bundle_sku (e.g., "ABC#4|DEF#0"), including if the number is #0
-                bundle_sku = str(row[col])
-                for sku in skus:
-                    new_row = row.copy()
-                    sku_parts = sku.split('#')
-                    new_row['final_sku'] = sku_parts[0]
-                    new_row['bundle_sku'] = bundle_sku
-                    if len(sku_parts) > 1:
-                        try:
-                            sku_quantity = int(sku_parts[1])
-                            if sku_quantity != 0:
-                                new_row['quantity'] = sku_quantity
-                            else:
-                                new_row['quantity'] = row['quantity']
-                        except ValueError:
-                            new_row['quantity'] = row['quantity']
-                    else:
-                        new_row['quantity'] = row['quantity']
-                    new_rows.append(new_row)
-                return new_rows
-        
-        # Handle case where both scpi and scp are None
-        if pd.isna(row['scpi_promotion_warehouse_sku']) and pd.isna(row['scp_promotion_warehouse_sku']):
-            if (prev_row is not None and 
-                prev_row['order_id'] == row['order_id'] and 
-                row['row_num'] - prev_row['row_num'] == 1 and
-                (pd.notna(prev_row['scpi_promotion_warehouse_sku']) or pd.notna(prev_row['scp_promotion_warehouse_sku']))):
-                new_row = row.copy()
-                new_row['final_sku'] = row['mint_soft_sku']
-                new_row['bundle_sku'] = None 
-                new_rows.append(new_row)
-                return new_rows
-        
-        # If no special case applies, return the original row
-        row['bundle_sku'] = None
-        return [row]
-
-    new_rows = []
-    prev_row = None
-    for _, row in df.iterrows():
-        new_rows.extend(split_row(row, prev_row))
-        prev_row = row
-
-    return pd.DataFrame(new_rows)
+    scpi_sku = df['scpi_promotion_warehouse_sku']
+    scp_sku = df['scp_promotion_warehouse_sku']
+
+    # We store the original bundle SKU in bundle_sku (e.g., "ABC#4|DEF#0"), including if the number is #0.
+    # The scpi SKU takes precedence over the scp SKU when both contain a pipe
+    bundle_sku = scpi_sku.where(sku_is_bundle(scpi_sku), scp_sku.where(sku_is_bundle(scp_sku)))
+    is_bundle = bundle_sku.notna().to_numpy()
+
+    reporting_pipe_df = df.copy()
+    reporting_pipe_df['bundle_sku'] = None
+
+    # Handle case where both scpi and scp are None, right after a row of the same order that has one of them
+    has_sku = scpi_sku.notna() | scp_sku.notna()
+    follows_sku_row = (
+        (df['order_id'] == df['order_id'].shift()) &
+        (df['row_num'] - df['row_num'].shift() == 1) &
+        has_sku.shift(fill_value=False)
+    )
+    reporting_pipe_df.loc[~has_sku & follows_sku_row, 'final_sku'] = df['mint_soft_sku']
+
+    # Repeat every bundle row once per SKU in the bundle, using the parsed parts of each distinct bundle SKU
+    codes, parsed_skus = encode_skus(bundle_sku)
+    parts_count = parsed_skus['part_skus'].str.len().to_numpy(dtype=np.int64)
+    parts_start = np.concatenate([[0], np.cumsum(parts_count)[:-1]]).astype(np.int64)
+    all_part_skus = np.array([sku for part_skus in parsed_skus['part_skus'] for sku in part_skus], dtype=object)
+    all_part_quantities = np.array([quantity for part_quantities in parsed_skus['part_quantities'] for quantity in part_quantities], dtype='float64')
+
+    bundle_codes = codes[is_bundle]
+    repeats = np.ones(len(df), dtype=np.int64)
+    repeats[is_bundle] = parts_count[bundle_codes]
+    reporting_pipe_df = reporting_pipe_df.iloc[np.repeat(np.arange(len(df)), repeats)]
+
+    # Position of each new row within its bundle, used to pick the matching SKU part
+    row_parts_count = parts_count[bundle_codes]
+    part_offset = np.arange(row_parts_count.sum()) - np.repeat(np.cumsum(row_parts_count) - row_parts_count, row_parts_count)
+    part_positions = np.repeat(parts_start[bundle_codes], row_parts_count) + part_offset
+    part_quantity = all_part_quantities[part_positions]
+
+    exploded = np.repeat(is_bundle, repeats)
+    final_sku = reporting_pipe_df['final_sku'].to_numpy(dtype=object, copy=True)
+    final_sku[exploded] = all_part_skus[part_positions]
+    reporting_pipe_df['final_sku'] = final_sku
+
+    new_bundle_sku = reporting_pipe_df['bundle_sku'].to_numpy(dtype=object, copy=True)
+    new_bundle_sku[exploded] = np.repeat(bundle_sku.to_numpy()[is_bundle], row_parts_count)
+    reporting_pipe_df['bundle_sku'] = new_bundle_sku
+
+    # Parts with #0 or without a valid number keep the quantity of the original row
+    quantity = reporting_pipe_df['quantity'].to_numpy(copy=True)
+    use_part_quantity = ~np.isnan(part_quantity) & (part_quantity != 0)
+    quantity[np.flatnonzero(exploded)[use_part_quantity]] = part_quantity[use_part_quantity]
+    reporting_pipe_df['quantity'] = quantity
+
+    return reporting_pipe_df
+
+
+def bundle_sort_key(df):
+    """Sorting key to prioritize the rows showing the bundle: both scp and scpi SKU first, then scpi, then scp, then none"""
+    has_scp = df['scp_promotion_warehouse_sku'].notna()
+    has_scpi = df['scpi_promotion_warehouse_sku'].notna()
+    return np.select([has_scp & has_scpi, has_scpi, has_scp], [0, 1, 2], default=3)
 
 
 def check_bundle_etc(df):
     """Function to separate bundle and non-bundle rows"""
     # Check which order_ids have a pipe character "|" in scpi_promotion_warehouse_sku or scp_promotion_warehouse_sku
-    bundle_orders = df.groupby('order_id').apply(
-        lambda x: x['scpi_promotion_warehouse_sku'].str.contains(r'\|', na=False).any() or 
-                  x['scp_promotion_warehouse_sku'].str.contains(r'\|', na=False).any()
-    )
-    
+    has_pipe = sku_is_bundle(df['scpi_promotion_warehouse_sku']) | sku_is_bundle(df['scp_promotion_warehouse_sku'])
+
     # Map this information back to the original dataframe
-    df['is_bundle'] = df['order_id'].map(bundle_orders)
+    df['is_bundle'] = df['order_id'].isin(df.loc[has_pipe, 'order_id'].unique())
 
     # re-create row_num to match the new index
     df['row_num'] = range(len(df))
@@ -264,39 +468,33 @@ def check_bundle_etc(df):
     return df
 
 
-def preparing_non_bundle(df):
-    """Function to prepare non-bundle data"""
-    # Create a new dataframe with only non-bundle rows and reset the index
-    non_bundle_df = df[df['is_bundle'] == False].copy()
-    non_bundle_df.reset_index(drop=True, inplace=True)
-
-    # Create a new dataframe with only bundle rows and reset the index
-    only_bundle_df = df[df['is_bundle'] == True].copy()
-    only_bundle_df.reset_index(drop=True, inplace=True)
-
-    # Define sorting key - each order_id with bundle has multiple rows, so we need to prioritize the one with bundles
-    def sorting_key(row):
-        if pd.notna(row['scp_promotion_warehouse_sku']) and pd.notna(row['scpi_promotion_warehouse_sku']):
-            return 0
-        elif pd.notna(row['scpi_promotion_warehouse_sku']):
-            return 1
-        elif pd.notna(row['scp_promotion_warehouse_sku']):
-            return 2
-        else:
-            return 3
+def sort_bundle_rows(df):
+    """Function to sort the bundle rows by order_id, prioritizing the rows showing the bundle"""
+    bundle_positions = np.flatnonzero(df['is_bundle'].to_numpy(dtype=bool))
 
-    # Sort the dataframe for only_bundle_df
-    only_bundle_df['sort_key'] = only_bundle_df.apply(sorting_key, axis=1)
-    only_bundle_df = only_bundle_df.sort_values(['order_id', 'sort_key'])
+    # Sort only the keys. The index of the result is the position of each row among the bundle rows
+    sort_keys = pd.DataFrame({
+        'order_id': df['order_id'].to_numpy()[bundle_positions],
+        'sort_key': bundle_sort_key(df)[bundle_positions]
+    })
+    sorted_rows = sort_keys.sort_values(['order_id', 'sort_key']).index
 
-    # Drop the temporary sorting column for only_bundle_df
-    only_bundle_df = only_bundle_df.drop(columns=['sort_key'])
+    # Return the position of each sorted bundle row in df, indexed by its position among the bundle rows
+    return pd.Series(bundle_positions[sorted_rows], index=sorted_rows)
 
-    # Combine both dataframes back to non_bundle_df
-    non_bundle_df = pd.concat([non_bundle_df, only_bundle_df], ignore_index=True)
-    
-    # Sort the combined dataframe by order_id if needed
-    non_bundle_df = non_bundle_df.sort_values('order_id').reset_index(drop=True)
+
+def preparing_non_bundle(df, sorted_bundle_rows):
+    """Function to prepare non-bundle data"""
+    # Non-bundle rows first, then the sorted bundle rows
+    row_positions = np.concatenate([
+        np.flatnonzero(~df['is_bundle'].to_numpy(dtype=bool)),
+        sorted_bundle_rows.to_numpy()
+    ])
+
+    # Sort the combined rows by order_id, then take them from df in a single pass
+    sort_keys = pd.DataFrame({'order_id': df['order_id'].to_numpy()[row_positions]})
+    row_positions = row_positions[sort_keys.sort_values('order_id', kind='stable').index]
+    non_bundle_df = df.iloc[row_positions].reset_index(drop=True)
     
     # Reset row_num to match the new index
     non_bundle_df['row_num'] = non_bundle_df.index
@@ -305,261 +503,450 @@ def preparing_non_bundle(df):
     return non_bundle_df
 
 
-def preparing_bundle(df):
+def preparing_bundle(df, sorted_bundle_rows):
     """Function to prepare only-bundle data"""
-    # Create a new dataframe with only bundle rows and reset the index
-    only_bundle_df = df[df['is_bundle'] == True].copy()
-    only_bundle_df.reset_index(drop=True, inplace=True)
+    # Keep only the first row for each order_id, since we have sorted out the rows that show the bundle first for each order_id
+    order_ids = df['order_id'].to_numpy()[sorted_bundle_rows.to_numpy()]
+    is_first_row = np.ones(len(order_ids), dtype=bool)
+    is_first_row[1:] = order_ids[1:] != order_ids[:-1]
+    first_rows = sorted_bundle_rows[is_first_row]
+
+    only_bundle_df = df.iloc[first_rows.to_numpy()].copy()
+    only_bundle_df.index = first_rows.index
 
     # Clean up bundle_sku by removing #number patterns
-    def clean_bundle_sku(sku):
-        if pd.isna(sku):
-            return sku
-        # Split by pipe, clean each part, then rejoin
-        parts = str(sku).split('|')
-        cleaned_parts = [part.split('#')[0] for part in parts]
-        return '|'.join(cleaned_parts)
-    
-    only_bundle_df['bundle_sku'] = only_bundle_df['bundle_sku'].apply(clean_bundle_sku)
-    
-    # Define sorting key - each order_id with bundle has multiple rows, so we need to prioritize the one with bundles
-    def sorting_key(row):
-        if pd.notna(row['scp_promotion_warehouse_sku']) and pd.notna(row['scpi_promotion_warehouse_sku']):
-            return 0
-        elif pd.notna(row['scpi_promotion_warehouse_sku']):
-            return 1
-        elif pd.notna(row['scp_promotion_warehouse_sku']):
-            return 2
-        else:
-            return 3
-
-    # Sort the dataframe
-    only_bundle_df['sort_key'] = only_bundle_df.apply(sorting_key, axis=1)
-    only_bundle_df = only_bundle_df.sort_values(['order_id', 'sort_key'])
-
-    # Create new columns
-    only_bundle_df['bundle_product_name'] = ''
-    only_bundle_df['bundle_variant_name'] = ''
-    only_bundle_df['bundle_product_id'] = None
-    only_bundle_df['bundle_variant_id'] = None
-    only_bundle_df['bundle_quantity'] = None
-
-    # Update new columns based on the first row of each order_id
-    for order_id in only_bundle_df['order_id'].unique():
-        order_group = only_bundle_df[only_bundle_df['order_id'] == order_id]
-        first_row = order_group.iloc[0]
-        
-        only_bundle_df.loc[only_bundle_df['order_id'] == order_id, 'bundle_product_name'] = first_row['product_name']
-        only_bundle_df.loc[only_bundle_df['order_id'] == order_id, 'bundle_variant_name'] = first_row['variant_name']
-        only_bundle_df.loc[only_bundle_df['order_id'] == order_id, 'bundle_product_id'] = first_row['product_id']
-        only_bundle_df.loc[only_bundle_df['order_id'] == order_id, 'bundle_variant_id'] = first_row['variant_id']
-        only_bundle_df.loc[only_bundle_df['order_id'] == order_id, 'bundle_quantity'] = first_row['original_quantity']
-
-    # Drop the temporary sorting column
-    only_bundle_df = only_bundle_df.drop(columns=['sort_key'])
+    codes, parsed_skus = encode_skus(only_bundle_df['bundle_sku'])
+    only_bundle_df['bundle_sku'] = np.where(
+        codes >= 0,
+        lookup_parsed_skus(parsed_skus, 'clean_bundle_sku', codes),
+        only_bundle_df['bundle_sku'].to_numpy(dtype=object)
+    )
+
+    # Create new columns based on the first row of each order_id
+    bundle_columns = {
+        'bundle_product_name': 'product_name',
+        'bundle_variant_name': 'variant_name',
+        'bundle_product_id': 'product_id',
+        'bundle_variant_id': 'variant_id',
+        'bundle_quantity': 'original_quantity'
+    }
+    for bundle_column, column in bundle_columns.items():
+        only_bundle_df[bundle_column] = only_bundle_df[column].astype(object)
 
     # Rename old columns
     only_bundle_df.rename(columns={'product_id': 'old_product_id', 'variant_id': 'old_variant_id', 'product_name': 'old_product_name', 'variant_name': 'old_variant_name'}, inplace=True)
 
-    # Keep only the first row for each order_id, since we have sorted out the rows that show the bundle first for each order_id
-    only_bundle_df = only_bundle_df.drop_duplicates(subset=['order_id'], keep='first')
-
     print(f"Created only-bundle dataframe with {len(only_bundle_df)} rows.")
     return only_bundle_df
 
 
-def load_non_bundle(df, target_table='report_apex_non_bundle', chunk_size=7000):
-    """Load data to the target table (non-bundle data)"""
-    # Select only the specified columns
-    columns_to_load = ['order_id', 'created_at', 'quantity', 'warehouse_sku']
-    df_to_load = df[columns_to_load]
+def partition_bundles(df):
+    """Function to split the rows into non-bundle and only-bundle data, sorting the bundle rows only once"""
+    df = check_bundle_etc(df)
+    sorted_bundle_rows = sort_bundle_rows(df)
 
-    try:
-        # Establish a connection using mysql.connector
-        connection = mysql.connector.connect(
-            database=target_db_name,
-            user=target_db_user,
-            password=target_db_password,
-            host=target_db_host,
-            port=target_db_port
-        )
-        
-        # Set autocommit to False
-        connection.autocommit = False
-        
-        cursor = connection.cursor()
+    non_bundle_df = preparing_non_bundle(df, sorted_bundle_rows)
+    only_bundle_df = preparing_bundle(df, sorted_bundle_rows)
+    return non_bundle_df, only_bundle_df
 
-        # Truncate the target table
-        truncate_query = f"TRUNCATE TABLE {target_table}"
-        cursor.execute(truncate_query)
-        print(f"Table '{target_table}' has been truncated.")
 
-        # Prepare the insert query
-        insert_query = f"""
-        INSERT INTO {target_table} (order_id, created_at, quantity, warehouse_sku)
-        VALUES (%s, %s, %s, %s)
-        """
+def non_bundle_rows(df):
+    """Cast the non-bundle columns to the types inserted in the target table"""
+    return pd.DataFrame({
+        'order_id': df['order_id'].astype('int64'),
+        'created_at': df['created_at'],
+        'quantity': df['quantity'].astype('int64'),
+        'warehouse_sku': df['warehouse_sku'].astype(str)
+    })
 
-        # Prepare all data for insertion
-        data_to_insert = [
-            (int(row['order_id']), row['created_at'], int(row['quantity']), str(row['warehouse_sku']))
-            for _, row in df_to_load.iterrows()
-        ]
 
-        # Insert data in chunks with executemany
-        total_inserted = 0
-        for i in range(0, len(data_to_insert), chunk_size):
-            chunk = data_to_insert[i:i + chunk_size]
-            cursor.executemany(insert_query, chunk)
-            total_inserted += len(chunk)
-            print(f"Inserted {total_inserted} rows so far...")
+def only_bundle_rows(df):
+    """Cast the only-bundle columns to the types inserted in the target table"""
+    return pd.DataFrame({
+        'order_id': df['order_id'].astype('int64'),
+        'created_at': df['created_at'],
+        'bundle_product_id': df['bundle_product_id'].astype('int64'),
+        'bundle_product_name': df['bundle_product_name'].astype(str),
+        'bundle_variant_id': df['bundle_variant_id'].astype('int64'),
+        'bundle_variant_name': df['bundle_variant_name'].astype(str),
+        'bundle_quantity': df['bundle_quantity'].astype('int64'),
+        'bundle_sku': df['bundle_sku'].where(df['bundle_sku'].notna(), None)
+    })
 
-        # Commit the changes
-        connection.commit()
 
-        # Set autocommit back to True
-        connection.autocommit = True
+def load_report_rows(context, data_to_insert, target_table, chunk_size=7000, replace_order_ids=None,
+                     use_shadow_table=True, parallelism=LOAD_PARALLELISM):
+    """Load the cast rows of a report table, replacing only the rows of replace_order_ids if given
 
-        print(f"Inserted {total_inserted} new row(s) in total.")
+    A full load goes through replace_table_rows. Returns the number of inserted rows, None if the load failed
+    """
+    try:
+        if replace_order_ids is None:
+            total_inserted = replace_table_rows(context.target_config, target_table, data_to_insert, chunk_size,
+                                                use_shadow_table, parallelism)
+        else:
+            connection = get_connection(context.target_config)
+            connection.autocommit = False
+            cursor = connection.cursor()
 
-        cursor.close()
-        connection.close()
+            # Delete the rows of the changed orders and insert their new rows in one transaction
+            total_deleted = delete_by_ids(cursor, target_table, 'order_id', replace_order_ids, chunk_size)
+            print(f"Deleted {total_deleted} row(s) of {len(replace_order_ids)} changed order(s) from '{target_table}'.")
+            total_inserted = bulk_insert(cursor, target_table, data_to_insert, chunk_size)
+            connection.commit()
+
+            connection.autocommit = True
+            cursor.close()
+            connection.close()
+
+        print(f"Inserted {total_inserted} new row(s) in total.")
+        return total_inserted
 
     except mysql.connector.Error as error:
         print(f"Error while connecting to the MySQL database: {error}")
+        # Hand the connection back to the pool, its open transaction is rolled back
+        if 'connection' in locals():
+            connection.close()
+
+
+def load_non_bundle(context, df, target_table='report_apex_non_bundle', chunk_size=7000, replace_order_ids=None, use_shadow_table=True,
+                    parallelism=LOAD_PARALLELISM):
+    """Load data to the target table (non-bundle data), see load_report_rows"""
+    return load_report_rows(context, non_bundle_rows(df[NON_BUNDLE_COLUMNS]), target_table, chunk_size,
+                            replace_order_ids, use_shadow_table, parallelism)
+
+
+def load_only_bundle(context, df, target_table='report_apex_only_bundle', chunk_size=7000, replace_order_ids=None, use_shadow_table=True,
+                     parallelism=LOAD_PARALLELISM):
+    """Load data to the target table (only-bundle data), see load_report_rows"""
+    return load_report_rows(context, only_bundle_rows(df[ONLY_BUNDLE_COLUMNS]), target_table, chunk_size,
+                            replace_order_ids, use_shadow_table, parallelism)
+
+
+def plan_run(context, full_refresh=False):
+    """Decide whether the run of the context's brand is a full refresh, kept in context.state with the watermark"""
+    # Run incrementally from the watermark, unless there is none yet or the last full refresh is too old
+    run_started_at = datetime.datetime.now()
+    watermark = get_watermark(context)
+    if watermark is None or run_started_at - watermark['last_full_refresh_at'] >= FULL_REFRESH_INTERVAL:
+        full_refresh = True
+
+    context.state.update(run_started_at=run_started_at, full_refresh=full_refresh, watermark=watermark)
+    return full_refresh
+
+
+def extract_brand(context, full_refresh=False):
+    """Extract the data of the context's brand, incremental since the last run unless a full refresh is requested or due
+
+    Returns None if there is nothing to process. What the load needs afterwards is kept in context.state
+    """
+    print(f"Starting ETL process for {context.brand}")
+    plan_run(context, full_refresh)
+    return extract_planned(context)
+
+
+def extract_planned(context):
+    """Extract the data of the run decided by plan_run, see extract_brand"""
+    watermark = context.state['watermark']
+    if context.state['full_refresh']:
+        # Taken before the extract, so the orders updated during this run are processed again by the next one.
+        # Without one, the watermark is left as it is and the next run is a full refresh again
+        new_watermark = latest_order_update(context)
+        replace_order_ids = None
+
+        print("Extracting data (full refresh)...")
+        extracted_data = extract(context)
+
+        if extracted_data.empty:
+            print("No data to process.")
+            return None
+    else:
+        changed_orders = extract_order_updates(context, watermark['updated_at'])
+        if changed_orders.empty:
+            print(f"No orders updated since {watermark['updated_at']}, nothing to process.")
+            return None
+        new_watermark = changed_orders['updated_at'].max().to_pydatetime()
+
+        print(f"Extracting data of {len(changed_orders)} order(s) updated since {watermark['updated_at']}...")
+        extracted_data = extract(context, changed_since=watermark['updated_at'])
+
+        # Orders updated after the query above are extracted too, so their rows are replaced as well.
+        # Changed orders that are no longer paid only get their rows deleted
+        replace_order_ids = changed_orders['id']
+        if not extracted_data.empty:
+            replace_order_ids = pd.concat([replace_order_ids, extracted_data['order_id']])
+        replace_order_ids = replace_order_ids.unique().tolist()
+
+    context.state.update(new_watermark=new_watermark, replace_order_ids=replace_order_ids)
+    return extracted_data
+
+
+def transform_report_frames(extracted_data, frames=None):
+    """Run the whole transform chain and return the non-bundle and only-bundle frames
+
+    The intermediate frames are stored in frames if given
+    """
+    if extracted_data.empty:
+        return pd.DataFrame(columns=NON_BUNDLE_COLUMNS), pd.DataFrame(columns=ONLY_BUNDLE_COLUMNS)
+
+    frames = frames if frames is not None else {}
 
+    print("Transforming data...")
+    reporting_df = frames['reporting_df'] = transform(extracted_data)
 
-def load_only_bundle(df, target_table='report_apex_only_bundle', chunk_size=7000):
-    """Load data to the target table (only-bundle data)"""
-    # Select only the specified columns
-    columns_to_load = ['order_id', 'created_at', 'bundle_product_id', 'bundle_product_name', 'bundle_variant_id', 'bundle_variant_name', 'bundle_quantity', 'bundle_sku']
-    df_to_load = df[columns_to_load]
+    print("Duplicating rows with pipe...")
+    reporting_pipe_df = frames['reporting_pipe_df'] = duplicate_rows_with_pipe(reporting_df)
 
+    print("Preparing non-bundle and only-bundle data...")
+    return partition_bundles(reporting_pipe_df)
+
+
+def load_brand(context, non_bundle_df, only_bundle_df):
+    """Load the frames of the context's brand and move its watermark forward, returns the number of rows loaded to each table"""
+    context.frames['non_bundle_df'] = non_bundle_df
+    context.frames['only_bundle_df'] = only_bundle_df
+    replace_order_ids = context.state['replace_order_ids']
+
+    # Get brand-specific table names
+    tables = get_target_table_names(context.brand)
+
+    # Number of connections loading each table, the two tables are loaded concurrently
+    parallelism = int(get_variable("etl_load_parallelism", default_var=LOAD_PARALLELISM))
+
+    print(f"Loading non-bundle data to {tables['non_bundle']} and only-bundle data to {tables['only_bundle']}...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        non_bundle_load = executor.submit(load_non_bundle, context, non_bundle_df, tables['non_bundle'],
+                                          replace_order_ids=replace_order_ids, parallelism=parallelism)
+        only_bundle_load = executor.submit(load_only_bundle, context, only_bundle_df, tables['only_bundle'],
+                                           replace_order_ids=replace_order_ids, parallelism=parallelism)
+        non_bundle_loaded = non_bundle_load.result()
+        only_bundle_loaded = only_bundle_load.result()
+
+    # Only move the watermark forward once both tables are loaded, otherwise the next run retries the same orders
+    if non_bundle_loaded is not None and only_bundle_loaded is not None and context.state['new_watermark'] is not None:
+        full_refresh_at = context.state['run_started_at'] if context.state['full_refresh'] else None
+        save_watermark(context, context.state['new_watermark'], full_refresh_at)
+
+    print(f"ETL process completed successfully for {context.brand}!")
+    return {'non_bundle': non_bundle_loaded, 'only_bundle': only_bundle_loaded}
+
+
+def partition_sizing(memory_budget_mb, workers):
+    """Number of workers and extracted rows per order_id range so that the ranges in flight fit in the memory budget"""
+    budget_rows = memory_budget_mb * 1024 * 1024 // BYTES_PER_EXTRACTED_ROW
+    workers = max(1, min(workers, budget_rows // MIN_PARTITION_ROWS))
+    return workers, max(MIN_PARTITION_ROWS, budget_rows // workers)
+
+
+def plan_order_ranges(context, rows_per_range):
+    """Split the extract of the context's brand into contiguous order_id ranges of about rows_per_range rows
+
+    Returns the (first, end) pairs for extract's order_range, with the number of orders they cover. The first
+    range has no lower bound and the last one no upper bound, so orders created after the sizing query are
+    still extracted
+    """
+    connection = get_connection(context.source_config)
     try:
-        # Establish a connection using mysql.connector
-        connection = mysql.connector.connect(
-            database=target_db_name,
-            user=target_db_user,
-            password=target_db_password,
-            host=target_db_host,
-            port=target_db_port
-        )
-        
-        # Set autocommit to False
-        connection.autocommit = False
-        
-        cursor = connection.cursor()
+        order_sizes = read_query(connection, f"""
+        SELECT soi.order_id, COUNT(*) AS row_count
+        {EXTRACT_JOINS}
+        GROUP BY soi.order_id
+        ORDER BY soi.order_id
+        """)
+    finally:
+        connection.close()
 
-        # Truncate the target table
-        truncate_query = f"TRUNCATE TABLE {target_table}"
-        cursor.execute(truncate_query)
-        print(f"Table '{target_table}' has been truncated.")
+    if order_sizes.empty:
+        return [(None, None)], 0
 
-        # Prepare the insert query
-        insert_query = f"""
-        INSERT INTO {target_table} (order_id, created_at, bundle_product_id, bundle_product_name, bundle_variant_id, bundle_variant_name, bundle_quantity, bundle_sku)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
+    # An order is never split, a range ends at the first order going over rows_per_range
+    range_index = (order_sizes['row_count'].cumsum().to_numpy() - 1) // rows_per_range
+    is_range_start = np.ones(len(range_index), dtype=bool)
+    is_range_start[1:] = range_index[1:] != range_index[:-1]
+    starts = [int(order_id) for order_id in order_sizes['order_id'].to_numpy()[is_range_start]]
 
-        # Prepare all data for insertion
-        data_to_insert = [
-            (int(row['order_id']), row['created_at'], int(row['bundle_product_id']), str(row['bundle_product_name']),
-             int(row['bundle_variant_id']), str(row['bundle_variant_name']), int(row['bundle_quantity']), row['bundle_sku'] if pd.notna(row['bundle_sku']) else None)
-            for _, row in df_to_load.iterrows()
-        ]
+    bounds = [None] + starts[1:] + [None]
+    return list(zip(bounds[:-1], bounds[1:])), len(order_sizes)
 
-        # Insert data in chunks with executemany
-        total_inserted = 0
-        for i in range(0, len(data_to_insert), chunk_size):
-            chunk = data_to_insert[i:i + chunk_size]
-            cursor.executemany(insert_query, chunk)
-            total_inserted += len(chunk)
-            print(f"Inserted {total_inserted} rows so far...")
 
-        # Commit the changes
-        connection.commit()
+def process_order_range(context, order_range, shadow_tables):
+    """Extract, transform and load one order_id range into the shadow tables, in a worker process
 
-        # Set autocommit back to True
-        connection.autocommit = True
+    Returns the number of rows loaded to each table, and the number of extracted orders
+    """
+    extracted_data = extract(context, order_range=order_range)
+    extracted_orders = extracted_data['order_id'].nunique() if not extracted_data.empty else 0
+    non_bundle_df, only_bundle_df = transform_report_frames(extracted_data)
+    del extracted_data
 
-        print(f"Inserted {total_inserted} new row(s) in total.")
+    non_bundle_rows_df = non_bundle_rows(non_bundle_df[NON_BUNDLE_COLUMNS])
+    only_bundle_rows_df = only_bundle_rows(only_bundle_df[ONLY_BUNDLE_COLUMNS])
+    del non_bundle_df, only_bundle_df
 
-        cursor.close()
+    # The rows of a range are committed on their own, the shadow tables are only visible after the swap
+    connection = get_connection(context.target_config)
+    try:
+        connection.autocommit = False
+        cursor = connection.cursor()
+        try:
+            loaded = {
+                'non_bundle': bulk_insert(cursor, shadow_tables['non_bundle'], non_bundle_rows_df),
+                'only_bundle': bulk_insert(cursor, shadow_tables['only_bundle'], only_bundle_rows_df)
+            }
+            connection.commit()
+        finally:
+            cursor.close()
+        return loaded, extracted_orders
+    except mysql.connector.Error:
+        connection.rollback()
+        raise
+    finally:
         connection.close()
 
-    except mysql.connector.Error as error:
-        print(f"Error while connecting to the MySQL database: {error}")
 
-    print("Data loading completed successfully.")
+def run_etl_partitioned(context):
+    """Full refresh of the context's brand, streamed through the transform chain one order_id range at a time
+
+    Every step of the transform only looks at the rows of one order, so the ranges are processed independently
+    by a pool of worker processes, each range being loaded as soon as it is transformed. The size of the ranges
+    keeps the ranges in flight within the memory budget. Returns the number of rows loaded to each table
+    """
+    workers = int(get_variable("etl_partition_workers", default_var=os.cpu_count() or 1))
+    memory_budget_mb = int(get_variable("etl_partition_memory_budget_mb", default_var=PARTITION_MEMORY_BUDGET_MB))
+    workers, rows_per_range = partition_sizing(memory_budget_mb, workers)
 
+    # Taken before the extract, as in extract_planned
+    new_watermark = latest_order_update(context)
 
-def etl_process(brand):
-    """ETL process for the given brand"""
+    order_ranges, planned_orders = plan_order_ranges(context, rows_per_range)
+    print(f"Processing {len(order_ranges)} order_id range(s) of about {rows_per_range} rows with {workers} worker(s)...")
+
+    tables = get_target_table_names(context.brand)
+    connection = get_connection(context.target_config)
+    cursor = connection.cursor()
     try:
-        print(f"Starting ETL process for {brand}")
+        # The ranges are loaded into shadow copies, swapped in once every range is loaded
+        shadow_tables = {name: create_shadow_table(cursor, table) for name, table in tables.items()}
+
+        loaded = {'non_bundle': 0, 'only_bundle': 0}
+        extracted_orders = 0
+        with ProcessPoolExecutor(max_workers=min(workers, len(order_ranges))) as executor:
+            futures = [executor.submit(process_order_range, context, order_range, shadow_tables)
+                       for order_range in order_ranges]
+            try:
+                for completed, future in enumerate(as_completed(futures), start=1):
+                    range_loaded, range_orders = future.result()
+                    for name, count in range_loaded.items():
+                        loaded[name] += count
+                    extracted_orders += range_orders
+                    print(f"Loaded {completed}/{len(futures)} order_id range(s) of {context.brand}...")
+            except Exception:
+                # The tables are left as they are, the shadow tables are dropped by the next run
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # The ranges together must cover every order of the sizing query, or the swap would drop report rows
+        if extracted_orders < planned_orders:
+            raise ValueError(f"The order_id ranges of {context.brand} extracted {extracted_orders} of "
+                             f"{planned_orders} orders, the tables are left as they are")
+
+        for name, table in tables.items():
+            swap_shadow_table(cursor, table)
+            print(f"Table '{table}' has been swapped with its shadow copy ({loaded[name]} rows).")
+    finally:
+        cursor.close()
+        connection.close()
 
-        # Set up database connections using brand-specific details
-        global source_crm_db_name, source_crm_db_user, source_crm_db_password, source_crm_db_host, source_crm_db_port
-        global target_db_name, target_db_user, target_db_password, target_db_host, target_db_port
+    if new_watermark is not None:
+        save_watermark(context, new_watermark, context.state['run_started_at'])
+    print(f"ETL process completed successfully for {context.brand}!")
+    return loaded
 
-        source_details = get_source_db_details(brand)
-        target_details = get_target_db_details()
 
-        # Set source connection details
-        source_crm_db_name = source_details['database']
-        source_crm_db_user = source_details['user']
-        source_crm_db_password = source_details['password']
-        source_crm_db_host = source_details['host']
-        source_crm_db_port = source_details['port']
+def run_etl(context, full_refresh=False, partitioned=False):
+    """ETL process for the context's brand, incremental since the last run unless a full refresh is requested or due
 
-        # Set target connection details
-        target_db_name = target_details['database']
-        target_db_user = target_details['user']
-        target_db_password = target_details['password']
-        target_db_host = target_details['host']
-        target_db_port = target_details['port']
+    With partitioned, a full refresh goes through run_etl_partitioned, incremental runs are small enough to stay in memory.
+    Returns the number of rows loaded to each table, or None if there was nothing to load
+    """
+    print(f"Starting ETL process for {context.brand}")
+    if plan_run(context, full_refresh) and partitioned:
+        return run_etl_partitioned(context)
 
-        print("Extracting data...")
-        extracted_data = extract()
+    extracted_data = extract_planned(context)
+    if extracted_data is None:
+        return None
 
-        if extracted_data.empty:
-            print("No data to process.")
-            return
+    non_bundle_df, only_bundle_df = transform_report_frames(extracted_data, context.frames)
+    return load_brand(context, non_bundle_df, only_bundle_df)
 
-        print("Transforming data...")
-        global reporting_df
-        reporting_df = transform(extracted_data)
 
-        print("Duplicating rows with pipe...")
-        global reporting_pipe_df
-        reporting_pipe_df = duplicate_rows_with_pipe(reporting_df)
+def run_etl_batched(brands=BRANDS, full_refresh=False):
+    """ETL process for several brands with a single transform over their stacked data
 
-        print("Adding bundles filter...")
-        global reporting_pipe_df_add_ons_bundle
-        reporting_pipe_df_add_ons_bundle = check_bundle_etc(reporting_pipe_df)
+    Every order_id carries its brand index in its high bits, so the orders of different brands are never mixed.
+    Returns the number of rows loaded to each table, per brand
+    """
+    contexts = [create_brand_context(brand) for brand in brands]
 
-        print("Preparing non-bundle data...")
-        global non_bundle_df
-        non_bundle_df = preparing_non_bundle(reporting_pipe_df_add_ons_bundle)
+    # The extracts only wait on MySQL, they run concurrently
+    with ThreadPoolExecutor(max_workers=len(contexts)) as executor:
+        extracted = list(executor.map(lambda context: extract_brand(context, full_refresh), contexts))
 
-        print("Preparing only-bundle data...")
-        global only_bundle_df
-        only_bundle_df = preparing_bundle(reporting_pipe_df_add_ons_bundle)
+    brand_frames = [df if df is not None else pd.DataFrame() for df in extracted]
+    print(f"Transforming the data of {len(brands)} brand(s) at once...")
+    stacked_data = stack_brand_frames(brand_frames, ['order_id'])
+    non_bundle_df, only_bundle_df = transform_report_frames(stacked_data)
 
-        # Get brand-specific table names
-        tables = get_target_table_names(brand)
+    non_bundle_dfs = split_brand_frame(non_bundle_df, 'order_id', len(contexts), ['order_id'])
+    only_bundle_dfs = split_brand_frame(only_bundle_df, 'order_id', len(contexts), ['order_id'])
 
-        print(f"Loading non-bundle data to {tables['non_bundle']}...")
-        load_non_bundle(non_bundle_df, tables['non_bundle'])
+    results = {}
+    for context, extracted_data, brand_non_bundle_df, brand_only_bundle_df in zip(contexts, extracted, non_bundle_dfs, only_bundle_dfs):
+        if extracted_data is None:
+            results[context.brand] = None
+            continue
+        # row_num is renumbered within each brand, as in a run of that brand alone
+        brand_non_bundle_df['row_num'] = brand_non_bundle_df.index
+        results[context.brand] = load_brand(context, brand_non_bundle_df, brand_only_bundle_df)
+    return results
 
-        print(f"Loading only-bundle data to {tables['only_bundle']}...")
-        load_only_bundle(only_bundle_df, tables['only_bundle'])
 
-        print(f"ETL process completed successfully for {brand}!")
+def use_partitioned_mode():
+    """Whether full refreshes stream the order_id ranges through a process pool (Variable etl_stock_partitioned)"""
+    return str(get_variable("etl_stock_partitioned", default_var='false')).lower() == 'true'
+
+
+def use_batched_mode():
+    """Whether run_all_brands transforms the brands together with run_etl_batched (Variable etl_stock_batched)"""
+    return str(get_variable("etl_stock_batched", default_var='false')).lower() == 'true'
+
+
+def etl_process(brand, full_refresh=False):
+    """ETL process for the given brand, errors are reported in the log"""
+    try:
+        return run_etl(create_brand_context(brand), full_refresh, use_partitioned_mode())
     except Exception as e:
         print(f"An error occurred during the ETL process for {brand}: {str(e)}")
 
 
+def run_brand(brand):
+    """Run the ETL process of one brand and raise its errors, for run_all_brands"""
+    return run_etl(create_brand_context(brand), partitioned=use_partitioned_mode())
+
+
+def run_all_brands(brands=BRANDS, max_workers=None, use_processes=True):
+    """Run the ETL process of several brands at once, and return a BrandResult per brand
+
+    In batched mode the brands share one in-memory transform, max_workers, use_processes and the partitioned
+    mode don't apply
+    """
+    if use_batched_mode():
+        return run_batched(run_etl_batched, brands)
+    return run_brands(run_brand, brands, max_workers, use_processes)
+
+
 def run_etl_process_by_brand(brand):
     """Run ETL process"""
     if brand not in BRANDS:
@@ -584,5 +971,7 @@ def run_etl_process_mno():
     etl_process('MNO')
 
 if __name__ == "__main__":
-    for brand in BRANDS:
-        run_etl_process_by_brand(brand)
+    # Optional argument: number of brands processed at once (all of them by default)
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    results = run_all_brands(max_workers=max_workers)
+    sys.exit(1 if any(result.error is not None for result in results.values()) else 0)
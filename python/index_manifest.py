@@ -0,0 +1,115 @@
+"""
+Check the plans of the extract queries against the index manifest (bash_script/index_manifest.json)
+
+Usage: python3 index_manifest.py BRAND
+
+Runs after the tables of the brand are transferred and renamed, and before the ETLs. The indexes of the manifest are
+created by copy_tables.py with the <table>_tmp copies. The EXPLAIN plan of every extract query is checked: only the
+tables listed in its full_scans may be read in full, and only one of them.
+"""
+
+import json
+import os
+import sys
+
+from db_utils import get_connection
+from etl_retention_and_sunset import BRANDS, get_target_db_details
+from transfer_manifest import etl_queries
+
+INDEX_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bash_script', 'index_manifest.json')
+
+# Access types of an EXPLAIN row reading the whole table or the whole index
+FULL_SCAN_TYPES = {'ALL', 'index'}
+
+# A full scan of a table estimated below this many rows is left to the optimizer, it can be cheaper than a lookup
+MIN_CHECKED_ROWS = 1000
+
+
+def load_index_manifest():
+    """Read the index manifest"""
+    with open(INDEX_MANIFEST_PATH, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def explain_query(connection, query):
+    """Get the rows of the EXPLAIN plan of a query"""
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(f"EXPLAIN {query}")
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def check_plan(name, plan, expected):
+    """List the problems of the EXPLAIN plan of a query against its expected plan, empty if it matches"""
+    problems = []
+    # Derived tables and materialized subqueries (<derived2>, <subquery3>, ...) are read in full by design
+    full_scans = [
+        row for row in plan
+        if row['type'] in FULL_SCAN_TYPES and (row['rows'] or 0) >= MIN_CHECKED_ROWS
+        and not str(row['table']).startswith('<')
+    ]
+    for row in full_scans:
+        if row['table'] not in expected['full_scans']:
+            problems.append(f"{name} reads {row['table']} in full ({row['type']}, about {row['rows']} rows), "
+                            f"instead of through an index")
+
+    # A second table read in full means one of the joins no longer uses an index
+    if len(full_scans) > 1:
+        problems.append(f"{name} reads {', '.join(row['table'] for row in full_scans)} in full, "
+                        f"only one table of a query should be")
+    return problems
+
+
+def check_plans(connection, plans):
+    """Check the EXPLAIN plans of the extract queries, and list the problems"""
+    problems = []
+    for name, query in etl_queries().items():
+        if name not in plans:
+            problems.append(f"{name} has no expected plan in the index manifest")
+            continue
+        problems.extend(check_plan(name, explain_query(connection, query), plans[name]))
+    return problems
+
+
+def check_index_manifest(brand):
+    """Check the extract plans on the database of a brand, and raise an error if one doesn't match"""
+    manifest = load_index_manifest()
+    db_details = get_target_db_details(brand)
+
+    connection = get_connection(db_details)
+    try:
+        problems = check_plans(connection, manifest['plans'])
+    finally:
+        connection.close()
+
+    for problem in problems:
+        print(f"ERROR: {problem}")
+    if problems:
+        raise ValueError(f"{len(problems)} problem(s) in the plans of the extract queries for {brand}")
+    print(f"The extract queries of {brand} use the indexes of the index manifest.")
+
+
+# Individual brand functions
+def run_index_manifest_abc():
+    check_index_manifest('ABC')
+
+def run_index_manifest_def():
+    check_index_manifest('DEF')
+
+def run_index_manifest_ghi():
+    check_index_manifest('GHI')
+
+def run_index_manifest_jkl():
+    check_index_manifest('JKL')
+
+def run_index_manifest_mno():
+    check_index_manifest('MNO')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in BRANDS:
+        print(f"Usage: index_manifest.py BRAND, with BRAND one of {BRANDS}", file=sys.stderr)
+        sys.exit(1)
+    check_index_manifest(sys.argv[1])
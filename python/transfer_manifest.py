@@ -0,0 +1,98 @@
+"""
+Check that the transfer manifest (bash_script/transfer_manifest.json) covers what the ETL queries read
+
+Usage: python3 transfer_manifest.py
+
+Exits with a non-zero status, listing the problems, if an ETL query reads a column the transfer leaves out,
+or reads orders in a payment state the row predicate of the manifest leaves out.
+"""
+
+import json
+import os
+import re
+import sys
+
+import etl_retention_and_sunset
+import etl_stock_flow_reports
+
+MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bash_script', 'transfer_manifest.json')
+
+# Words that can follow a table name in a FROM or JOIN clause, and are not an alias
+SQL_KEYWORDS = {'on', 'where', 'left', 'right', 'inner', 'outer', 'cross', 'join', 'group', 'order', 'limit', 'using'}
+
+
+def etl_queries():
+    """Get the extract queries of the ETLs, by name"""
+    return {
+        'etl_stock_flow_reports.extract': f"SELECT {etl_stock_flow_reports.EXTRACT_COLUMNS} {etl_stock_flow_reports.EXTRACT_JOINS}",
+        'etl_retention_and_sunset.ORDERS_QUERY': etl_retention_and_sunset.ORDERS_QUERY,
+        'etl_retention_and_sunset.ITEMS_QUERY': etl_retention_and_sunset.ITEMS_QUERY,
+        'etl_retention_and_sunset.RANKED_ITEMS_QUERY': etl_retention_and_sunset.RANKED_ITEMS_QUERY
+    }
+
+
+def table_aliases(query):
+    """Map the aliases (and names) of the tables of a query to the table names"""
+    aliases = {}
+    for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+`?(\w+)`?(?:\s+(?:AS\s+)?`?(\w+)`?)?', query, re.IGNORECASE):
+        aliases[table] = table
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def referenced_columns(query):
+    """Get the (table, column) pairs a query reads through qualified column names"""
+    aliases = table_aliases(query)
+    return {
+        (aliases[alias], column)
+        for alias, column in re.findall(r'\b(\w+)\.`?(\w+)`?', query)
+        if alias in aliases
+    }
+
+
+def payment_states(sql):
+    """Get the payment states of the payment_state IN (...) filters of a query"""
+    states = set()
+    for values in re.findall(r'payment_state\s+IN\s*\(([^)]*)\)', sql, re.IGNORECASE):
+        states.update(re.findall(r"'([^']*)'", values))
+    return states
+
+
+def check_manifest(manifest, queries):
+    """List the problems of the manifest against the queries, empty if the manifest covers them"""
+    problems = []
+    for name, query in queries.items():
+        for table, column in sorted(referenced_columns(query)):
+            if table in manifest and column not in manifest[table]['columns']:
+                problems.append(f"{name} reads {table}.{column}, which is not in the manifest")
+
+        # The rows of a table with a predicate are only transferred for the payment states of the predicate
+        query_states = payment_states(query)
+        for table, projection in manifest.items():
+            if 'where' not in projection:
+                continue
+            missing_states = query_states - payment_states(projection['where'])
+            if missing_states:
+                problems.append(f"{name} reads orders in payment states {', '.join(sorted(missing_states))}, "
+                                f"which the predicate of {table} leaves out")
+    return problems
+
+
+def main():
+    """Check the manifest against the ETL queries, and return a non-zero status if it doesn't cover them"""
+    with open(MANIFEST_PATH, encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    problems = check_manifest(manifest, etl_queries())
+    for problem in problems:
+        print(f"ERROR: {problem}")
+    if problems:
+        return 1
+
+    print("The transfer manifest covers the ETL queries.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())